@@ -1,15 +1,24 @@
 from django.contrib import admin
-from models import Grade
+from models import Grade, GradeAudit
 
 class GradeAdmin(admin.ModelAdmin):
     list_display = ('id', 'grade_value',  'reason_description')
-    list_display_links = ('grade_value', 'reason_description')
+    list_display_links = ('grade_value', )
     list_per_page = 1000
     ordering = ('-id',)
 
 
 admin.site.register(Grade, GradeAdmin)
 
+class GradeAuditAdmin(admin.ModelAdmin):
+    list_display = ('grade', 'qactual', 'old_value', 'new_value', 'note',
+                    'date_and_time')
+    list_per_page = 1000
+    ordering = ('-id',)
+
+
+admin.site.register(GradeAudit, GradeAuditAdmin)
+
 
 
 from django.contrib.auth.admin import UserAdmin
@@ -0,0 +1,58 @@
+"""
+Converts the JSON lists of reason descriptions, stored by earlier versions
+in ``grades_grade.reason_description``, to the ``Grade.reasons`` bitmask.
+Add the new column first; e.g. with SQLite:
+
+    ALTER TABLE grades_grade ADD COLUMN reasons integer NOT NULL DEFAULT 0;
+    python manage.py convert_grade_reasons
+
+The ``reason_description`` column can be dropped afterwards.
+"""
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from grades.models import Grade, REASON_CODES, reasons_mask, IN_CLAUSE_SIZE
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class Command(BaseCommand):
+    help = ('Stores the old JSON grading reasons as the bitmask in '
+            '"Grade.reasons".')
+
+    def handle(self, *args, **options):
+        codes = dict((text, code) for code, text in REASON_CODES)
+        cursor = connection.cursor()
+        cursor.execute('SELECT id, reason_description FROM %s WHERE '
+                       'reason_description IS NOT NULL' %
+                       Grade._meta.db_table)
+
+        grade_ids = {}      # the grades to set, by bitmask
+        unknown = set()
+        for grade_id, description in cursor.fetchall():
+            try:
+                texts = json.loads(description)
+            except ValueError:
+                texts = [description]
+            if not isinstance(texts, list):
+                texts = [texts]
+
+            known = [codes[text] for text in texts if text in codes]
+            unknown.update(text for text in texts if text not in codes)
+            if known:
+                grade_ids.setdefault(reasons_mask(known), []).append(grade_id)
+
+        with transaction.atomic():
+            for mask, ids in grade_ids.iteritems():
+                for start in xrange(0, len(ids), IN_CLAUSE_SIZE):
+                    Grade.objects.filter(id__in=ids[start:start+\
+                                                    IN_CLAUSE_SIZE])\
+                                 .update(reasons=mask)
+
+        self.stdout.write('Converted the reasons of %d grades' %
+                          sum(len(ids) for ids in grade_ids.values()))
+        for text in sorted(unknown):
+            self.stdout.write('Unknown reason, not kept: %s' % text)
@@ -0,0 +1,39 @@
+"""
+Grades every ungraded question in a QSet, after the deadline. With the
+``GRADING_PROCESSES`` setting (or ``--processes``) above 1 the questions are
+scored by a pool of processes, which is only safe outside the web server:
+
+    python manage.py grade_qset <course-slug> <qset-slug> --processes=4
+"""
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from question.models import get_qset
+from grades.views import grade_qset
+
+
+class Command(BaseCommand):
+    args = '<course-slug> <qset-slug>'
+    help = 'Grades the ungraded questions in a QSet.'
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', default=None,
+                    help='Number of processes that grade (default: the '
+                         'GRADING_PROCESSES setting)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Provide the course and the QSet slugs')
+        qset = get_qset(args[0], args[1])
+        if qset is None:
+            raise CommandError('QSet "%s" not found in course "%s"' %
+                               (args[1], args[0]))
+
+        processes = options['processes'] or \
+                                settings.QUEST.get('GRADING_PROCESSES', 1)
+        n_graded, n_failed, duration = grade_qset(qset, processes=processes)
+        self.stdout.write(('Graded %d question(s) in %.1f seconds (%.0f per '
+                           'second); %d could not be graded') % (n_graded,
+                           duration, n_graded / max(duration, 1E-6), n_failed))
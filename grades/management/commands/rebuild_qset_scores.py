@@ -0,0 +1,29 @@
+"""
+Recomputes the ``QSetScore`` grade totals from the questions and their
+grades. Run it once after the table is created, and after changing the
+``max_grade`` of a template that is already in use:
+
+    python manage.py rebuild_qset_scores [<course-slug>]
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from course.models import Course
+from question.models import QSet
+from grades.models import rebuild_qset_scores
+
+
+class Command(BaseCommand):
+    args = '[<course-slug>]'
+    help = 'Recomputes the grade totals of every user in every QSet.'
+
+    def handle(self, *args, **options):
+        qsets = None
+        if len(args) == 1:
+            if not Course.objects.filter(slug=args[0]).exists():
+                raise CommandError('Course "%s" not found' % args[0])
+            qsets = QSet.objects.filter(course__slug=args[0])
+        elif args:
+            raise CommandError('Provide at most one course slug')
+
+        n_scores = rebuild_qset_scores(qsets)
+        self.stdout.write('Rebuilt %d QSet scores' % n_scores)
@@ -0,0 +1,61 @@
+"""
+Grades the questions of a template, or of a QSet, again after the grading
+key was corrected. Only the grades that change are updated; each change is
+recorded in a ``GradeAudit``, so it is safe to run more than once:
+
+    python manage.py regrade <qtemplate-id> --note="Fixed the key"
+
+or for all the questions in a QSet:
+
+    python manage.py regrade <course-slug> <qset-slug> --dry-run
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from question.models import QTemplate, QActual, get_qset
+from grades.views import regrade_quests
+
+
+class Command(BaseCommand):
+    args = '<qtemplate-id> | <course-slug> <qset-slug>'
+    help = ('Regrades the questions from a template, or a QSet, and updates '
+            'the grades that change.')
+    option_list = BaseCommand.option_list + (
+        make_option('--note', default='',
+                    help='Why the questions are regraded (for the audit log)'),
+        make_option('--dry-run', action='store_true', default=False,
+                    help='Only show the changes; do not save them'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) == 1:
+            try:
+                qtemplate = QTemplate.objects.get(id=int(args[0]))
+            except (ValueError, QTemplate.DoesNotExist):
+                raise CommandError('Question template "%s" not found' %
+                                   args[0])
+            quests = QActual.objects.filter(qtemplate=qtemplate)
+            what = 'template %d' % qtemplate.id
+        elif len(args) == 2:
+            qset = get_qset(args[0], args[1])
+            if qset is None:
+                raise CommandError('QSet "%s" not found in course "%s"' %
+                                   (args[1], args[0]))
+            quests = QActual.objects.filter(qset=qset)
+            what = 'QSet "%s"' % qset
+        else:
+            raise CommandError('Provide a template id, or the course and '
+                               'the QSet slugs')
+
+        note = options['note'] or 'Regraded %s' % what
+        changes = regrade_quests(quests, note=note,
+                                 dry_run=options['dry_run'])
+        if int(options['verbosity']) > 1 or options['dry_run']:
+            for change in changes:
+                self.stdout.write('QActual %d: %s -> %s' % (change.qactual_id,
+                                  change.old_value, change.new_value))
+
+        self.stdout.write('%s grades %s for %s' % (len(changes),
+                          'would change' if options['dry_run'] else 'changed',
+                          what))
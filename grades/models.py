@@ -1,9 +1,35 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import signals, Sum, Count
 
-try:
-    import simplejson as json
-except ImportError:
-    import json
+from question.models import QActual
+
+# Why marks were lost. Each reason is one bit of ``Grade.reasons``, in this
+# order: only ever add new reasons at the end.
+REASON_CODES = (
+    ('SigFigs', 'Too many significant figures'),
+    ('MCQ', 'Lost grades for checking incorrect entries and/or not checking all correct entries'),
+    ('Not answered', 'Question was not answered'),
+    ('Wrong value', 'Wrong answer given'),
+    ('No match', 'Answer could not be matched with the template'),
+    ('Blank answer', 'Blank answer'),
+    ('Brief feedback', 'Feedback is too brief; or not actionable/constructive/specific enough'),
+    ('Not convertable', 'Answer could not converted to a numeric result'),
+    ('Spelling', 'Accepted, but the answer has a spelling mistake'),
+)
+REASON_BITS = dict((code, 1 << idx) for idx, (code, _) in
+                   enumerate(REASON_CODES))
+
+def reasons_mask(codes):
+    """ The ``Grade.reasons`` bitmask for a list of reason codes """
+    mask = 0
+    for code in codes or []:
+        mask |= REASON_BITS[code]
+    return mask
+
+def reason_texts(mask):
+    """ The descriptions of the reasons set in a ``Grade.reasons`` mask """
+    return [text for idx, (_, text) in enumerate(REASON_CODES)
+            if mask & (1 << idx)]
 
 class Grade(models.Model):
     """
@@ -22,20 +48,219 @@ class Grade(models.Model):
     # If ``approved``, then the grade is used in the calculations.
     approved = models.BooleanField(default=False)
 
-    # Reasons/description related to grading. e.g. could list deductions.
-    # such as '-0.5 for per incorrect multiple choice' or 'too many significant
-    # figures'
-    # It is a JSON encoded list of strings.
-    reason_description = models.CharField(blank=True, null=True,
-                                          max_length=250)
+    # Reasons related to grading, e.g. 'too many significant figures'. A
+    # bitmask over ``REASON_CODES``; see ``reasons_mask``.
+    reasons = models.IntegerField(default=0)
 
     def save(self, *args, **kwargs):
         """ Override the model's saving function to do some changes """
-        if isinstance(self.reason_description, list):
-            self.reason_description = json.dumps(self.reason_description)
+        if isinstance(self.reasons, (list, tuple)):
+            self.reasons = reasons_mask(self.reasons)
         super(Grade, self).save(*args, **kwargs)
 
+    @property
+    def reason_description(self):
+        """ The reasons, for display """
+        return '; '.join(reason_texts(self.reasons))
+
     def __unicode__(self):
 
         return '[%d] [%f]: %s' % (self.id, self.grade_value, str(self.reason_description))
 
+
+class GradeAudit(models.Model):
+    """
+    A change made to a ``Grade`` when questions were regraded (see
+    ``grades.views.regrade_quests``).
+    """
+    grade = models.ForeignKey(Grade)
+    qactual = models.ForeignKey('question.QActual')
+
+    old_value = models.FloatField()
+    new_value = models.FloatField()
+    old_reasons = models.IntegerField(default=0)
+    new_reasons = models.IntegerField(default=0)
+
+    # Why the questions were regraded
+    note = models.CharField(blank=True, max_length=250)
+    date_and_time = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return '[%d] [%f] -> [%f]: %s' % (self.grade_id, self.old_value,
+                                          self.new_value, self.note)
+
+
+class QSetScore(models.Model):
+    """
+    The grade totals of a user in a QSet, kept up to date from the user's
+    ``QActual`` questions and their grades (see ``refresh_qset_scores``).
+
+    When upgrading an existing site, create the table and then run
+    ``python manage.py rebuild_qset_scores`` once: until then, the grade
+    pages show no grades for questions graded before the upgrade.
+    """
+    user = models.ForeignKey('person.UserProfile')
+    qset = models.ForeignKey('question.QSet')
+
+    # Sums of ``qtemplate.max_grade`` and of the ``grade.grade_value``
+    max_grade = models.FloatField(default=0.0)
+    actual_grade = models.FloatField(default=0.0)
+
+    # Number of questions, and how many of them are graded
+    n_quests = models.IntegerField(default=0)
+    n_graded = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('user', 'qset'), )
+
+    def __unicode__(self):
+        return '%s in %s: %f/%f' % (self.user_id, self.qset_id,
+                                    self.actual_grade, self.max_grade)
+
+    def is_graded(self):
+        """ Grades are only shown once all questions are graded """
+        return self.n_graded == self.n_quests
+
+
+def count_reason(grades, code):
+    """
+    How many of the ``grades`` (a Grade queryset) lost marks for the reason
+    ``code``, in a single query. For example, the students who gave too many
+    significant figures in a question template ``qtemplate``:
+
+        count_reason(Grade.objects.filter(qactual__qtemplate=qtemplate),
+                     'SigFigs')
+    """
+    return grades.extra(where=['(%s.reasons & %%s) != 0' %
+                               Grade._meta.db_table],
+                        params=[REASON_BITS[code]]).count()
+
+
+# Largest number of ids placed in one "IN (...)" SQL clause
+IN_CLAUSE_SIZE = 500
+
+def score_totals(quests):
+    """
+    The grade totals of the QActual queryset ``quests``, as unsaved
+    ``QSetScore`` objects: one per (user, QSet), from one aggregate query.
+    """
+    totals = quests.filter(qset__isnull=False).order_by()\
+                   .values('user', 'qset')\
+                   .annotate(max_grade=Sum('qtemplate__max_grade'),
+                             actual_grade=Sum('grade__grade_value'),
+                             n_quests=Count('id'),
+                             n_graded=Count('grade'))
+    return [QSetScore(user_id=item['user'], qset_id=item['qset'],
+                      max_grade=float(item['max_grade'] or 0.0),
+                      actual_grade=float(item['actual_grade'] or 0.0),
+                      n_quests=item['n_quests'], n_graded=item['n_graded'])
+            for item in totals]
+
+SCORE_FIELDS = ('max_grade', 'actual_grade', 'n_quests', 'n_graded')
+
+def refresh_qset_scores(pairs):
+    """
+    Recomputes the ``QSetScore`` of each (user id, QSet id) in ``pairs``
+    from their questions, in one transaction. Used by the signal handlers
+    below, and by code that grades questions in bulk (``update()`` does not
+    send signals).
+
+    The existing rows are locked and updated in place, and missing ones
+    created with ``get_or_create``, so that two requests refreshing the
+    same score at once do not both try to create it.
+    """
+    users_by_qset = {}
+    for user_id, qset_id in set(pairs):
+        if qset_id is not None:
+            users_by_qset.setdefault(qset_id, []).append(user_id)
+
+    with transaction.atomic():
+        for qset_id, user_ids in users_by_qset.iteritems():
+            for start in xrange(0, len(user_ids), IN_CLAUSE_SIZE):
+                chunk = user_ids[start:start+IN_CLAUSE_SIZE]
+                totals = dict((score.user_id, score) for score in
+                              score_totals(QActual.objects.filter(
+                                            qset=qset_id, user__in=chunk)))
+                existing = dict((score.user_id, score) for score in
+                                QSetScore.objects.select_for_update()\
+                                         .filter(qset=qset_id, user__in=chunk))
+                for user_id in chunk:
+                    score, old = totals.get(user_id), existing.get(user_id)
+                    if score is None:
+                        if old is not None:
+                            old.delete()  # the user has no questions left
+                        continue
+
+                    values = dict((field, getattr(score, field)) for field in
+                                  SCORE_FIELDS)
+                    if old is None:
+                        old, created = QSetScore.objects.get_or_create(
+                                            user_id=user_id, qset_id=qset_id,
+                                            defaults=values)
+                        if created:
+                            continue
+                    if any(getattr(old, field) != value for field, value in
+                           values.iteritems()):
+                        QSetScore.objects.filter(id=old.id).update(**values)
+
+def rebuild_qset_scores(qsets=None):
+    """
+    Recomputes all the ``QSetScore`` rows (of the ``qsets`` queryset, if
+    given) from scratch. Needed after a template's ``max_grade`` is changed.
+    """
+    scores = QSetScore.objects.all()
+    quests = QActual.objects.all()
+    if qsets is not None:
+        scores = scores.filter(qset__in=qsets)
+        quests = quests.filter(qset__in=qsets)
+
+    with transaction.atomic():
+        scores.delete()
+        new_scores = score_totals(quests)
+        QSetScore.objects.bulk_create(new_scores, batch_size=IN_CLAUSE_SIZE)
+    return len(new_scores)
+
+def score_state(instance):
+    # The fields that change the totals: answers are saved far more often.
+    # (``__dict__`` avoids loading the fields of a deferred instance.)
+    return tuple(instance.__dict__.get(field) for field in
+                 ('user_id', 'qset_id', 'grade_id', 'qtemplate_id'))
+
+def track_quest_grade(sender, instance, **kwargs):
+    instance._score_state = score_state(instance)
+
+def quest_saved(sender, instance, created=False, **kwargs):
+    state = score_state(instance)
+    previous = getattr(instance, '_score_state', None)
+    if created or state != previous:
+        pairs = [(instance.user_id, instance.qset_id)]
+        if previous:
+            pairs.append(previous[:2])
+        refresh_qset_scores(pairs)
+    instance._score_state = state
+
+def quest_deleted(sender, instance, **kwargs):
+    refresh_qset_scores([(instance.user_id, instance.qset_id)])
+
+def grade_saved(sender, instance, created=False, **kwargs):
+    # A new grade is not linked to a question yet
+    if not created:
+        refresh_qset_scores(instance.qactual_set.values_list('user', 'qset'))
+
+def connect_score_signals(sender, **kwargs):
+    """
+    Connects the handlers above to QActual and Grade, and to the subclasses
+    Django 1.7 generates for deferred instances (from ``only()`` or
+    ``defer()``): those are the sender when such an instance is saved.
+    """
+    model = sender._meta.concrete_model
+    if model is QActual:
+        signals.post_init.connect(track_quest_grade, sender)
+        signals.post_save.connect(quest_saved, sender)
+        signals.post_delete.connect(quest_deleted, sender)
+    elif model is Grade:
+        signals.post_save.connect(grade_saved, sender)
+
+connect_score_signals(QActual)
+connect_score_signals(Grade)
+signals.class_prepared.connect(connect_score_signals)
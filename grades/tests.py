@@ -1,4 +1,9 @@
-from django.test import TestCase
+import json
+import datetime
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.core.management import call_command
 #from django.test.client import Client
 #from django.core.urlresolvers import reverse
 #from person.models import Token, UserProfile, Timing
@@ -8,11 +13,435 @@ from django.test import TestCase
 #from question.models import (QTemplate, QActual, QSet)
 #import datetime
 
+from person.models import User, UserProfile, Group
+from question.models import QActual, QTemplate
+from question.tests import create_graded_quests
+import grades.views
+from grades.models import Grade, GradeAudit, QSetScore, count_reason
+from grades.views import (grade_qset, grade_submitted_quests, regrade_quests,
+                          build_grades, save_bulk_grades,
+                          compare_numeric_batch,
+                          compare_numeric_with_precision, short_grading_key,
+                          grade_summary, export_grades, analyze_items,
+                          string_match, peer_eval_comments,
+                          ShortRule)
+
 try:
     import wingdbstub
 except ImportError:
     pass
 
+class NumericComparison_TestCases(TestCase):
+    def test_batch_matches_scalar_comparison(self):
+        """ The vectorized comparison gives the same results and reasons """
+        corrects = [[56.2, 1E-2, 'rel'], [71.34, 1E-2, 'abs'],
+                    [-4.5, 0.1, 'relative'], [10, 0, 'abs']]
+        givens = ['56.7', '55.6', ' 5.62e1 ', '', 'abc', u'\u22124.5',
+                  '71.35', '71.33', '71.3', '-4.949', '-4.95', '+10',
+                  '10.0000001', '1e400', '.5']
+        all_corrects, all_givens = [], []
+        for correct in corrects:
+            for given in givens:
+                all_corrects.append(correct)
+                all_givens.append(given)
+
+        expected = [compare_numeric_with_precision(correct, given) for
+                    correct, given in zip(all_corrects, all_givens)]
+        self.assertEqual(compare_numeric_batch(all_corrects, all_givens),
+                         expected)
+
+        # Without the fallback, only plain numbers are decided
+        out = compare_numeric_batch([[56.2, 1E-2, 'rel']]*3,
+                                    ['56.7', '', u'\u221256'], fallback=False)
+        self.assertEqual(out, [(True, None), None, None])
+
+
+class StringMatch_TestCases(TestCase):
+    def test_exact_match(self):
+        """ Capitals, hyphens and spaces around the answer are ignored """
+        correct = ['Well-mixed', 'CSTR']
+        self.assertEqual(string_match(correct, ' well mixed '), (True, None))
+        self.assertEqual(string_match(correct, 'Well-Mixed'), (True, None))
+        self.assertEqual(string_match(correct, 'cstr'), (True, None))
+        self.assertEqual(string_match(correct, 'well mixd'),
+                         (False, 'No match'))
+
+    def test_fuzzy_match(self):
+        """ With the option, one typing mistake in longer answers is allowed """
+        quest = dict(settings.QUEST, FUZZY_STRING_MATCH=True,
+                     FUZZY_MIN_LENGTH=5)
+        with self.settings(QUEST=quest):
+            correct = ('Reactor', 'Y')
+            for given in ('reactr', 'Reacctor', 'reaktor', 'REACTOR'):
+                self.assertEqual(string_match(correct, given)[0], True)
+            self.assertEqual(string_match(correct, 'reaktor'),
+                             (True, 'Spelling'))
+            for given in ('N', 'YY', 'raectro', 'reactors!'):
+                self.assertEqual(string_match(correct, given),
+                                 (False, 'No match'))
+
+    def test_fuzzy_min_length_changed(self):
+        """ A changed FUZZY_MIN_LENGTH applies to answers already indexed """
+        correct = ('Valve', )
+        for min_length, expected in ((5, True), (6, False), (5, True)):
+            quest = dict(settings.QUEST, FUZZY_STRING_MATCH=True,
+                         FUZZY_MIN_LENGTH=min_length)
+            with self.settings(QUEST=quest):
+                self.assertEqual(string_match(correct, 'valv')[0], expected)
+
+
+class GradingKey_TestCases(TestCase):
+    def test_short_grading_key(self):
+        """ Legacy forms are normalized once, and shared between students """
+        grading = json.dumps({'a1': ['[5.0, 0.1, "abs"]'], 'a2': ['Yes,Y'],
+                              'a3': 3})
+        key = short_grading_key(QActual(qtemplate_id=1, grading_answer=grading,
+                                        var_dict='{}'))
+        self.assertEqual(sorted(key),
+                         [ShortRule('a1', (5.0, 0.1, 'abs'), False),
+                          ShortRule('a2', ('Yes', 'Y'), True),
+                          ShortRule('a3', (3, 0, 'abs'), False)])
+
+        other = QActual(qtemplate_id=1, grading_answer=grading, var_dict='{}')
+        self.assertIs(short_grading_key(other), key)
+        other.grading_answer = json.dumps({'a1': ['[6.0, 0.1, "abs"]']})
+        self.assertEqual(list(short_grading_key(other)),
+                         [ShortRule('a1', (6.0, 0.1, 'abs'), False)])
+
+    def test_malformed_field(self):
+        """ A field with a malformed answer does not stop the others grading """
+        grading = json.dumps({'a1': ['[5.0, 0.1, "abs"]'], 'a2': [None]})
+        key = short_grading_key(QActual(qtemplate_id=2, grading_answer=grading,
+                                        var_dict='{}'))
+        self.assertEqual(sorted(key),
+                         [ShortRule('a1', (5.0, 0.1, 'abs'), False),
+                          ShortRule('a2', None, False)])
+
+
+class BatchGrading_TestCases(TestCase):
+    fixtures = ['initial_data',]
+    def setUp(self):
+        user = User.objects.create(username='quest-grader-previewer')
+        self.grader, _ = UserProfile.objects.get_or_create(user=user)
+        self.grader.role = 'Grader'
+        self.grader.save()
+
+    def test_grade_qset(self):
+        """ Only the ungraded questions are graded, and linked to a grade """
+        student, qsets = create_graded_quests(n_qsets=2, n_quests=5)
+        student.courses.add(qsets[0].course)
+        first = QActual.objects.filter(qset=qsets[1]).order_by('id')[0]
+        QActual.objects.filter(id=first.id).update(given_answer='{}')
+        n_grades = Grade.objects.count()
+
+        self.assertEqual(grade_qset(qsets[0])[:2], (0, 0))
+        n_graded, n_failed, _ = grade_qset(qsets[1])
+        self.assertEqual((n_graded, n_failed), (5, 0))
+        self.assertEqual(Grade.objects.count(), n_grades + 5)
+
+        grades = [qa.grade for qa in QActual.objects.filter(qset=qsets[1])]
+        self.assertEqual(len(set(grade.id for grade in grades)), 5)
+        for grade in grades:
+            self.assertEqual(grade.graded_by, self.grader)
+            self.assertEqual(grade.grade_value, 0.0)
+
+    def test_grade_on_submit(self):
+        """ Submitted objective questions are graded once, at submission """
+        student, qsets = create_graded_quests(n_qsets=2, n_quests=3)
+        quests = QActual.objects.filter(qset=qsets[1]).order_by('id')
+        QActual.objects.filter(id__in=[qa.id for qa in quests[:2]])\
+                       .update(is_submitted=True, given_answer='{}')
+        quest_ids = [qa.id for qa in quests]
+
+        self.assertEqual(grade_submitted_quests(quest_ids), 2)
+        self.assertEqual(grade_submitted_quests(quest_ids), 0)
+        self.assertEqual(QActual.objects.filter(qset=qsets[1],
+                                        grade__isnull=True).count(), 1)
+
+    def test_edited_while_grading(self):
+        """ A question edited after it was scored is not given the grade """
+        student, qsets = create_graded_quests(n_qsets=2, n_quests=3)
+        quests = list(QActual.objects.filter(qset=qsets[1]).order_by('id'))
+        graded = build_grades([(qa.id, 1.0, None) for qa in quests],
+                              self.grader)
+        last_edits = dict((qa.id, qa.last_edit) for qa in quests)
+        QActual.objects.filter(id=quests[0].id).update(last_edit=\
+                                    quests[0].last_edit + datetime.timedelta(1))
+        n_grades = Grade.objects.count()
+
+        save_bulk_grades(graded, self.grader, last_edits=last_edits)
+        linked = QActual.objects.filter(qset=qsets[1], grade__isnull=False)
+        self.assertEqual(sorted(linked.values_list('id', flat=True)),
+                         [qa.id for qa in quests[1:]])
+        self.assertEqual(set(qa.grade.grade_value for qa in linked), set([1.0]))
+        self.assertEqual(Grade.objects.count(), n_grades + 2)
+
+    def test_regrade(self):
+        """ Only changed grades are updated, and regrading is repeatable """
+        student, qsets = create_graded_quests(n_qsets=2, n_quests=4)
+        student.courses.add(qsets[0].course)
+        QActual.objects.filter(qset=qsets[1]).update(given_answer=\
+                                                     '{"abcd": "x"}')
+        qtemplate = QTemplate.objects.get(name='Graded question')
+        qtemplate.t_grading = json.dumps({'x': ['lure'], 'y': ['key']})
+        qtemplate.save()
+        grade_qset(qsets[1])
+
+        # The key was wrong; the grades made by the student are kept
+        qtemplate.t_grading = json.dumps({'x': ['key'], 'y': ['lure']})
+        qtemplate.save()
+        quests = QActual.objects.filter(qtemplate=qtemplate)
+        self.assertEqual(len(regrade_quests(quests, dry_run=True)), 4)
+        self.assertEqual(GradeAudit.objects.count(), 0)
+
+        changes = regrade_quests(quests, note='Fixed key')
+        self.assertEqual([(c.old_value, c.new_value) for c in changes],
+                         [(0.0, 2.0)] * 4)
+        self.assertEqual(GradeAudit.objects.filter(note='Fixed key').count(),
+                         4)
+        for quest in quests.select_related('grade'):
+            self.assertEqual(quest.grade.grade_value,
+                             2.0 if quest.qset == qsets[1] else 1.0)
+        self.assertEqual(regrade_quests(quests), [])
+
+class PooledGrading_TestCases(TransactionTestCase):
+    """ Grading with a pool of processes: outside a transaction, as a command
+    does. """
+    fixtures = ['initial_data',]
+    def setUp(self):
+        user = User.objects.create(username='quest-grader-previewer')
+        grader, _ = UserProfile.objects.get_or_create(user=user)
+        grader.role = 'Grader'
+        grader.save()
+        self.min_chunk = grades.views.MIN_GRADING_CHUNK
+        grades.views.MIN_GRADING_CHUNK = 2
+
+    def tearDown(self):
+        grades.views.MIN_GRADING_CHUNK = self.min_chunk
+
+    def test_grade_qset_processes(self):
+        """ A pool of processes gives the same grades as a single process """
+        student, qsets = create_graded_quests(n_qsets=2, n_quests=10)
+        student.courses.add(qsets[0].course)
+        quests = QActual.objects.filter(qset=qsets[1])
+        QActual.objects.filter(id__in=list(quests.values_list('id',
+                                                    flat=True))[:4])\
+                       .update(given_answer='{"abcd": "x"}')
+        QTemplate.objects.filter(name='Graded question').update(t_grading=\
+                                json.dumps({'x': ['key'], 'y': ['lure']}))
+        n_grades = Grade.objects.count()
+
+        with self.settings(QUEST=dict(settings.QUEST, GRADING_PROCESSES=2)):
+            call_command('grade_qset', qsets[1].course.slug, qsets[1].slug)
+        self.assertEqual(Grade.objects.count(), n_grades + 10)
+        self.assertEqual(quests.filter(grade__isnull=True).count(), 0)
+        self.assertEqual(sorted(qa.grade.grade_value for qa in
+                                quests.select_related('grade')),
+                         [0.0] * 6 + [2.0] * 4)
+
+class GradeSummary_TestCases(TestCase):
+    fixtures = ['initial_data',]
+    def test_grade_summary_queries(self):
+        """ The gradebook does not query per student, QSet or question """
+        student, qsets = create_graded_quests(n_qsets=3, n_quests=4)
+        course = qsets[0].course
+        student.courses.add(course)
+        for idx in range(5):
+            user = User.objects.create(username='other-%d' % idx,
+                                       email='other.%d@example.com' % idx)
+            other, _ = UserProfile.objects.get_or_create(user=user)
+            other.courses.add(course)
+
+        request = RequestFactory().get('/')
+        request.user = student.user
+        with self.assertNumQueries(3):
+            response = grade_summary(request, course.slug)
+
+        rows = dict(line.strip(' |').split(', ', 1) for line in
+                    response.content.split('\n'))
+        self.assertEqual(len(rows), 6)
+        self.assertTrue("' 50.0'" in rows['grade.student'])
+        self.assertTrue("'  nan'" in rows['grade.student'])
+
+    def test_export_grades(self):
+        """ The CSV export has a row per student; grades only when graded """
+        student, qsets = create_graded_quests(n_qsets=2, n_quests=4)
+        course = qsets[0].course
+        student.student_number = '0012345'
+        student.save()
+        student.courses.add(course)
+        staff = User.objects.create(username='staff', is_staff=True)
+
+        request = RequestFactory().get('/')
+        request.user = staff
+        response = export_grades(request, course.slug)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        lines = ''.join(response.streaming_content).splitlines()
+
+        header = lines[0].decode('utf-8-sig').split(',')
+        self.assertEqual(header[-2:], ['Average', 'Letter'])
+        rows = dict((line.split(',')[0], line.split(',')) for line in
+                    lines[1:])
+        row = rows['0012345']
+        self.assertEqual(row[header.index('Quest 0')], '50.0')
+        self.assertEqual(row[header.index('Quest 1')], '')
+        self.assertEqual(row[-2:], ['50.0', 'D-'])
+
+class QSetScore_TestCases(TestCase):
+    fixtures = ['initial_data',]
+    def setUp(self):
+        user = User.objects.create(username='quest-grader-previewer')
+        grader, _ = UserProfile.objects.get_or_create(user=user)
+        grader.role = 'Grader'
+        grader.save()
+
+    def test_scores_follow_grades(self):
+        """ The totals are kept up to date, and can be rebuilt """
+        student, qsets = create_graded_quests(n_qsets=2, n_quests=3)
+        student.courses.add(qsets[0].course)
+        def score(qset):
+            score = QSetScore.objects.get(user=student, qset=qset)
+            return score.actual_grade, score.n_graded, score.n_quests
+
+        self.assertEqual(score(qsets[0]), (3.0, 3, 3))
+        self.assertEqual(score(qsets[1]), (0.0, 0, 3))
+
+        # Saving an answer does not touch the totals
+        quest = QActual.objects.filter(qset=qsets[1])[0]
+        quest.given_answer = '{"abcd": "x"}'
+        with self.assertNumQueries(1):
+            quest.save()
+
+        QTemplate.objects.filter(name='Graded question').update(t_grading=\
+                                json.dumps({'x': ['lure'], 'y': ['key']}))
+        grade_qset(qsets[1])
+        self.assertEqual(score(qsets[1]), (0.0, 3, 3))
+
+        grade = QActual.objects.filter(qset=qsets[0])[0].grade
+        grade.grade_value = 2.0
+        grade.save()
+        self.assertEqual(score(qsets[0]), (4.0, 3, 3))
+
+        QActual.objects.filter(qset=qsets[0])[0].delete()
+        self.assertEqual(score(qsets[0])[1:], (2, 2))
+
+        fields = ('user', 'qset', 'max_grade', 'actual_grade', 'n_quests',
+                  'n_graded')
+        before = list(QSetScore.objects.order_by('id').values_list(*fields))
+        call_command('rebuild_qset_scores')
+        self.assertEqual(sorted(QSetScore.objects.values_list(*fields)),
+                         sorted(before))
+
+    def test_deferred_quest_saved(self):
+        """ Grading a question loaded with ``only()`` updates the totals """
+        student, qsets = create_graded_quests(n_qsets=2, n_quests=3)
+        quest = QActual.objects.filter(qset=qsets[1])\
+                               .only('id', 'user', 'qset', 'grade')[0]
+        quest.grade = Grade.objects.create(graded_by=student, grade_value=2.0)
+        quest.save()
+        score = QSetScore.objects.get(user=student, qset=qsets[1])
+        self.assertEqual((score.actual_grade, score.n_graded), (2.0, 1))
+        self.assertEqual(QSetScore.objects.filter(user=student).count(), 2)
+
+class ItemAnalysis_TestCases(TestCase):
+    fixtures = ['initial_data',]
+    def test_analyze_items(self):
+        """ Difficulty, discrimination and histograms per template """
+        student, qsets = create_graded_quests(n_qsets=1, n_quests=0)
+        grades = {'A': [0, 0, 2, 2], 'B': [2, 2, 2, 2], 'C': [0, 1, 1, 2]}
+        templates = dict((name, QTemplate.objects.create(name=name,
+                                q_type='mcq', contributor=student, max_grade=2,
+                                t_question='?', t_grading='{}'))
+                         for name in grades)
+        for idx in range(4):
+            user = User.objects.create(username='item-%d' % idx)
+            profile, _ = UserProfile.objects.get_or_create(user=user)
+            for name, values in grades.iteritems():
+                grade = Grade.objects.create(graded_by=student,
+                                             grade_value=values[idx])
+                QActual.objects.create(qtemplate=templates[name],
+                                       qset=qsets[0], user=profile,
+                                       grade=grade)
+
+        items = dict((item['name'], item) for item in
+                     analyze_items(QActual.objects.filter(qset=qsets[0])))
+        self.assertEqual(items['A']['n'], 4)
+        self.assertAlmostEqual(items['A']['difficulty'], 0.5)
+        self.assertAlmostEqual(items['A']['discrimination'], 0.5 ** 0.5)
+        self.assertEqual(items['A']['histogram'], [2, 0, 0, 0, 0, 0, 0, 0, 0, 2])
+        self.assertEqual(items['A']['flags'], [])
+
+        self.assertEqual(items['B']['discrimination'], None)
+        self.assertEqual(items['B']['flags'], ['Too easy',
+                                               'Non-discriminating'])
+
+class GradeReasons_TestCases(TestCase):
+    fixtures = ['initial_data',]
+    def test_reason_bitmask(self):
+        """ Reasons are stored as a bitmask, and can be counted in SQL """
+        student, qsets = create_graded_quests(n_qsets=1, n_quests=3)
+        grades = [quest.grade for quest in QActual.objects.filter(
+                                        qset=qsets[0]).order_by('id')]
+        grades[0].reasons = ['SigFigs', 'Wrong value']
+        grades[0].save()
+        grades[1].reasons = ['SigFigs']
+        grades[1].save()
+
+        self.assertEqual(Grade.objects.get(id=grades[0].id).reason_description,
+                        'Too many significant figures; Wrong answer given')
+        self.assertEqual(Grade.objects.get(id=grades[2].id).reason_description,
+                         '')
+
+        qtemplate = QTemplate.objects.get(name='Graded question')
+        quest_grades = Grade.objects.filter(qactual__qtemplate=qtemplate)
+        with self.assertNumQueries(1):
+            self.assertEqual(count_reason(quest_grades, 'SigFigs'), 2)
+        self.assertEqual(count_reason(quest_grades, 'Wrong value'), 1)
+        self.assertEqual(count_reason(quest_grades, 'MCQ'), 0)
+
+class PeerEval_TestCases(TestCase):
+    fixtures = ['initial_data',]
+    def test_peer_eval_comments(self):
+        """ Comments and ratings are gathered for the whole group at once """
+        student, qsets = create_graded_quests(n_qsets=1, n_quests=0)
+        qtemplate = QTemplate.objects.create(name='Peer review',
+                                q_type='peer-eval', contributor=student,
+                                max_grade=1, t_question='?', t_grading='{}')
+        group = Group.objects.create(name='Group 1')
+        profiles = {}
+        for username, first, last in (('ann', 'Ann', 'A'), ('bob', 'Bob', 'B'),
+                                      ('cat', 'Cat', 'C')):
+            user = User.objects.create(username=username, first_name=first,
+                                       last_name=last)
+            profiles[username], _ = UserProfile.objects.get_or_create(
+                                                                    user=user)
+            profiles[username].group = group
+            profiles[username].save()
+
+        # An older peer-evaluation, without a ``grading_answer``
+        ann = QActual.objects.create(qtemplate=qtemplate, qset=qsets[0],
+                user=profiles['ann'], grading_answer='',
+                given_answer=json.dumps({'pf__bob': '3', 'cm_b': 'Good work'}),
+                as_displayed=('<p><strong>Bob B</strong>: what was '
+                              'constructive? <textarea name="cm_b"></textarea>'))
+        QActual.objects.create(qtemplate=qtemplate, qset=qsets[0],
+                user=profiles['bob'], given_answer='{"pf__ann": "4"}',
+                grading_answer=json.dumps({'pf__ann': [4], 'cm_a': ['Ann A',
+                                          'Appreciated', 'Nice']}))
+        QActual.objects.create(qtemplate=qtemplate, qset=qsets[0],
+                               user=profiles['cat'], given_answer='')
+
+        comments = peer_eval_comments(QActual.objects.filter(
+                                                        qtemplate=qtemplate))
+        self.assertEqual(comments[profiles['ann'].id],
+                         [['Bob B', 'Appreciated: Nice\n', 4],
+                          ['Cat C', '--No comment--', 0],
+                          ['Merged', 'Appreciated: Nice\n', -99.9]])
+        self.assertEqual(comments[profiles['bob'].id][0],
+                         ['Ann A', 'Constructive: Good work\n', 3])
+        self.assertEqual(json.loads(QActual.objects.get(id=ann.id)\
+                                    .grading_answer)['pf__bob'], [3])
+
 #class Login_TestCases(TestCase):
     #def test_login_before_start(self):
         #c = Client(HTTP_USER_AGENT='ABC')  # enforce_csrf_checks=True,
@@ -5,7 +5,8 @@ import views
 urlpatterns = patterns('',
 
     # NOTE: all these URLs are preceded by "_grading/"
-    url(r'fix-glitch', views.fix_glitch),
+    url(r'item-analysis/(?P<course_code_slug>.+)/(?P<question_set_slug>.+)/$', views.item_analysis, name='grading-item-analysis'),
+    url(r'export-grades/(?P<course_code_slug>.+)/$', views.export_grades, name='grading-export-grades'),
     url(r'process-grades/(?P<course_code_slug>.+)/(?P<question_set_slug>.+)/$', views.process_grades, name='grading-process-grades'),
     url(r'process-grades/(?P<course_code_slug>.+)/$', views.grade_summary, name='grading-summary'),
 
@@ -1,17 +1,28 @@
 import re
+import csv
 try:
     import simplejson as json
 except ImportError:
     import json
 
+import time
+import hashlib
+import datetime
 import logging
+import multiprocessing
+from collections import namedtuple
 logger = logging.getLogger('quest')
 
-#from django.conf import settings
+from django.conf import settings
 from django.core.context_processors import csrf
 #from django.core.exceptions import ValidationError
 #from django.template import Context, Template, Library
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import StreamingHttpResponse
+from django.db import connection, transaction
+from django.db.models import Max, Count
+from django.core.cache import cache
 from django.core.context_processors import csrf
 from django.shortcuts import (HttpResponse, render_to_response,
                               RequestContext)
@@ -21,25 +32,47 @@ from django.shortcuts import (HttpResponse, render_to_response,
 import numpy as np
 
 # Our imports
-from question.models import (QTemplate, QActual, Inclusion, QSet)
+from question.models import (QTemplate, QActual, Inclusion, QSet, get_qset)
 from question.views import validate_user
 from person.models import UserProfile
-from grades.models import Grade
-from utils import insert_evaluate_variables, send_email
+from grades.models import (Grade, GradeAudit, QSetScore, refresh_qset_scores,
+                           IN_CLAUSE_SIZE, reasons_mask)
+from utils import (insert_evaluate_variables, send_email,
+                   convert_percentage_to_letter)
 from course.models import Course
 
-reason_codes = {'SigFigs': 'Too many significant figures',
-                'MCQ': 'Lost grades for checking incorrect entries and/or not checking all correct entries',
-                'Not answered': 'Question was not answered',
-                'Wrong value': 'Wrong answer given',
-                'No match': 'Answer could not be matched with the template',
-                'Blank answer': 'Blank answer',
-                'Brief feedback': 'Feedback is too brief; or not actionable/constructive/specific enough',
-                'Not convertable': 'Answer could not converted to a numeric result'}
-
 negative_deduction_multi = 0.5
 negative_sigfigs = 0.25
 
+# Question types that are graded, without a TA, as soon as they are submitted
+OBJECTIVE_TYPES = ('tf', 'mcq', 'multi', 'short')
+
+# Smallest number of questions worth sending to another grading process
+MIN_GRADING_CHUNK = 50
+
+# Item analysis: questions are flagged if the average fraction of the grade
+# obtained is above (too easy) or below (too hard) these limits, or if the
+# score is not correlated with the rest of the test (non-discriminating)
+ITEM_TOO_EASY = 0.9
+ITEM_TOO_HARD = 0.3
+ITEM_MIN_DISCRIMINATION = 0.2
+ITEM_HISTOGRAM_BINS = 10
+ITEM_ANALYSIS_CACHE_KEY = 'quest-item-analysis-%s'
+ITEM_ANALYSIS_TIMEOUT = 60 * 60 * 24
+
+# Compiled grading keys: see ``mcq_grading_key`` and ``short_grading_key``
+MCQKey = namedtuple('MCQKey', 'options correct')
+ShortRule = namedtuple('ShortRule', 'key correct string_answer')
+
+# The normalized correct answers of a string answer: see ``answer_index``
+AnswerIndex = namedtuple('AnswerIndex', 'exact deletions substitutions')
+_answer_indexes = {}
+
+# Compiled grading keys, by (kind, template id, version). Templates with
+# random variables add one key per student, so this is emptied when full.
+GRADING_KEY_CACHE_SIZE = 5000
+_grading_keys = {}
+
 
 def get_auto_grader():
     """ Get the UserProfile for the ``auto-grader''
@@ -54,7 +87,8 @@ def process_grades(request, course_code_slug, question_set_slug):
     Processes the grades for a given course and question set. The main entry
     point for initiating grading.
 
-    Displays a list of students and the grades achieved.
+    Displays a list of students and the grades achieved. Grades in this
+    process only: use the ``grade_qset`` command to grade with several.
     """
     course = validate_user(request, course_code_slug, question_set_slug,
                            admin=True)
@@ -63,53 +97,355 @@ def process_grades(request, course_code_slug, question_set_slug):
     if isinstance(course, tuple):
         course, qset = course
 
-    # Iterate through all questions by all students in the QSet
-    students = UserProfile.objects.filter(courses__slug=course_code_slug)
-    qset_questions = QActual.objects.filter(qset__slug=question_set_slug)
+    n_graded, n_failed, duration = grade_qset(qset, processes=1)
+    return HttpResponse(('Graded %d question(s) in %.1f seconds (%.0f per '
+                         'second); %d could not be graded') % (n_graded,
+                         duration, n_graded / max(duration, 1E-6), n_failed))
 
-    count = 0
-    for student in students:
-        for qactual in qset_questions.filter(user=student).order_by('id'):
-            if qactual.grade:
-                # Do not re-grade a question that has already received a grade
-                continue
+
+def grade_qset(qset, processes=1):
+    """
+    Grades every ungraded question (QActual) of the students in the ``qset``,
+    in bulk: the questions are loaded in one query, the grading information
+    for each template is parsed once, and the grades are written in a single
+    transaction. Questions that already have a grade are not re-graded.
+
+    With more than one of ``processes`` the questions are graded in chunks,
+    by a pool of forked processes; only this process writes to the database.
+    Never fork from the web server, which has other threads running: only
+    the ``grade_qset`` command uses a pool.
+
+    Returns the number of questions graded, the number that could not be
+    graded, and the time taken (in seconds).
+    """
+    start = time.time()
+    grader = get_auto_grader()
+    quests = QActual.objects.filter(qset=qset, grade__isnull=True,
+                                    user__courses=qset.course)\
+                            .select_related('qtemplate').order_by('id')
+    quests = list(quests)
+
+    if processes > 1 and len(quests) > processes * MIN_GRADING_CHUNK:
+        # A few chunks per process, so that slow chunks even out
+        size = max(MIN_GRADING_CHUNK, len(quests) // (processes * 4) + 1)
+        chunks = [quests[idx:idx+size] for idx in xrange(0, len(quests),
+                                                         size)]
+
+        # Forked processes must not share the database connection: close it
+        # before forking; this process opens a new one afterwards.
+        connection.close()
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(score_quests, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        scores = [item for chunk in results for item in chunk]
+    else:
+        scores = score_quests(quests)
+
+    graded = build_grades(scores, grader)
+    if graded:
+        save_bulk_grades(graded, grader)
+
+    return len(graded), len(quests) - len(graded), time.time() - start
+
+
+def score_quests(quests):
+    """
+    Grades the list of ``quests`` without touching the database. Returns a
+    list of (QActual id, grade value, reason) tuples; questions that cannot
+    be graded are logged, and left out.
+    """
+    short_rules, numeric_results = compare_short_answers(quests)
+
+    scores = []
+    for qactual in quests:
+        try:
+            extra = {}
+            if qactual.id in short_rules:
+                extra = {'rules': short_rules[qactual.id],
+                         'numeric_results': numeric_results[qactual.id]}
+            grade_value, reason = score_quest(qactual, **extra)
+        except Exception, e:
+            logger.error('Could not grade QActual %s: %s' % (qactual.id,
+                                                             str(e)))
+            continue
+
+        scores.append((qactual.id, grade_value, reason))
+
+    return scores
+
+
+def compare_short_answers(quests):
+    """
+    Makes all the numeric comparisons for the answered short answer
+    ``quests`` at once, with ``compare_numeric_batch``.
+
+    Returns the parsed rules, keyed by QActual id, and the comparison
+    results, keyed by QActual id and then by answer field.
+    """
+    short_rules = {}
+    numeric_results = {}
+    fields, corrects, givens = [], [], []
+    for qactual in quests:
+        if qactual.qtemplate.q_type not in ('short', ) or \
+                      not qactual.given_answer or not qactual.grading_answer:
+            continue
+        try:
+            token_dict = json.loads(qactual.given_answer)
+            rules = short_answer_rules(qactual, token_dict)
+        except Exception:
+            continue  # reported when the question itself is graded
+
+        short_rules[qactual.id] = rules
+        numeric_results[qactual.id] = {}
+        for key, correct, string_answer in rules:
+            if correct is not None and not string_answer:
+                fields.append((qactual.id, key))
+                corrects.append(correct)
+                givens.append(token_dict[key])
+
+    results = compare_numeric_batch(corrects, givens, fallback=False)
+    for (qactual_id, key), result in zip(fields, results):
+        if result is not None:
+            numeric_results[qactual_id][key] = result
+
+    return short_rules, numeric_results
+
+
+def save_bulk_grades(graded, grader, last_edits=None):
+    """
+    Creates the ``Grade`` objects, and links them to their questions, in one
+    transaction. ``graded`` is a list of (QActual id, unsaved Grade) tuples.
+
+    If ``last_edits`` (QActual id: ``last_edit``) is given, only questions
+    that have not been edited since, and are still ungraded, get a grade.
+    """
+    grades = [item[1] for item in graded]
+    with transaction.atomic():
+        if lock_grade_table():
+            Grade.objects.bulk_create(grades, batch_size=500)
+
+            # ``bulk_create`` does not set the primary keys. No other grades
+            # can be created until the transaction ends, so the newest grades
+            # are the ones just created, in order.
+            grade_ids = list(Grade.objects.filter(graded_by=grader)\
+                                          .order_by('-id')\
+                                          .values_list('id', flat=True)\
+                                          [:len(grades)])[::-1]
+        else:
+            grade_ids = []
+            for grade in grades:
+                grade.save()
+                grade_ids.append(grade.id)
+
+        link_grades(zip([item[0] for item in graded], grade_ids), last_edits)
+
+
+def lock_grade_table():
+    """
+    Stops other transactions from creating grades until this one ends, so
+    that the ids of grades created in bulk can be found again. Returns False
+    if the database cannot do this; grades must be saved one at a time then.
+    """
+    if connection.vendor == 'sqlite':
+        # SQLite allows only one writer: the first insert takes the lock
+        return True
+    elif connection.vendor == 'postgresql':
+        connection.cursor().execute('LOCK TABLE %s IN SHARE ROW EXCLUSIVE '
+                        'MODE' % connection.ops.quote_name(Grade._meta.db_table))
+        return True
+    return False
+
+
+def link_grades(links, last_edits=None):
+    """
+    Sets the grade of each question in the (QActual id, Grade id) ``links``,
+    with one UPDATE statement for every ``IN_CLAUSE_SIZE`` questions. Grades
+    that could not be linked (see ``save_bulk_grades``) are deleted.
+    """
+    qn = connection.ops.quote_name
+    table = qn(QActual._meta.db_table)
+    grade_col = qn(QActual._meta.get_field('grade').column)
+    edit_col = qn(QActual._meta.get_field('last_edit').column)
+    id_col = qn(QActual._meta.pk.column)
+    cursor = connection.cursor()
+
+    unlinked = []
+    linked = []
+    for start in xrange(0, len(links), IN_CLAUSE_SIZE):
+        chunk = dict(links[start:start+IN_CLAUSE_SIZE])
+        cases, params = [], []
+        for qactual_id, grade_id in chunk.iteritems():
+            if last_edits is None:
+                cases.append('WHEN ' + id_col + ' = %s THEN %s')
+                params.extend([qactual_id, grade_id])
+            else:
+                cases.append('WHEN ' + id_col + ' = %s AND ' + edit_col +
+                             ' = %s THEN %s')
+                params.extend([qactual_id, connection.ops.value_to_db_datetime(
+                                           last_edits[qactual_id]), grade_id])
+        sql = 'UPDATE %s SET %s = CASE %s ELSE %s END WHERE %s IN (%s)' % (
+                    table, grade_col, ' '.join(cases), grade_col, id_col,
+                    ', '.join(['%s'] * len(chunk)))
+        params.extend(chunk.keys())
+        if last_edits is not None:
+            sql += ' AND %s IS NULL' % grade_col
+        cursor.execute(sql, params)
+
+        for qactual_id, grade_id in QActual.objects.filter(id__in=chunk.keys())\
+                                           .values_list('id', 'grade'):
+            new_grade_id = chunk.pop(qactual_id)
+            if new_grade_id == grade_id:
+                linked.append(qactual_id)
             else:
-                do_grading(qactual)
-            count += 1
+                unlinked.append(new_grade_id)
+        unlinked.extend(chunk.values())     # questions that were deleted
 
-    return HttpResponse('Graded %d question(s)' % count)
+    if unlinked:
+        Grade.objects.filter(id__in=unlinked).delete()
 
+    # ``update()`` does not send the signals that keep the totals up to date
+    pairs = set()
+    for start in xrange(0, len(linked), IN_CLAUSE_SIZE):
+        pairs.update(QActual.objects.filter(id__in=\
+                                        linked[start:start+IN_CLAUSE_SIZE])\
+                                    .values_list('user', 'qset'))
+    refresh_qset_scores(pairs)
 
-def do_grading(qactual):
+
+def build_grades(scores, grader):
     """
-    Performs the grading of a question (QActual) for a single student.
+    Unsaved ``Grade`` objects for the (QActual id, grade value, reasons)
+    ``scores``, in the form used by ``save_bulk_grades``.
+    """
+    graded = []
+    for qactual_id, grade_value, reason in scores:
+        graded.append((qactual_id, Grade(graded_by=grader,
+                                         approved=True,
+                                         grade_value=grade_value,
+                                         reasons=reasons_mask(reason))))
+    return graded
+
+
+def grade_submitted_quests(quest_ids):
+    """
+    Grades the objective questions (see ``OBJECTIVE_TYPES``) among the
+    submitted ``quest_ids`` right away, so the grades are available as soon
+    as the QSet is over. Run in the background when answers are submitted;
+    ``grade_qset`` grades the rest after the deadline.
+
+    A question whose answer is changed in the meantime is left ungraded.
+    """
+    quests = list(QActual.objects.filter(id__in=quest_ids, is_submitted=True,
+                                         grade__isnull=True,
+                                    qtemplate__q_type__in=OBJECTIVE_TYPES)\
+                                 .select_related('qtemplate'))
+    if not quests:
+        return 0
+
+    grader = get_auto_grader()
+    graded = build_grades(score_quests(quests), grader)
+    if graded:
+        save_bulk_grades(graded, grader, last_edits=dict((quest.id,
+                                quest.last_edit) for quest in quests))
+    return len(graded)
+
+
+def regrade_quests(quests, note='', dry_run=False):
+    """
+    Grades the ``quests`` (a QActual queryset) again, with the current
+    grading keys, and compares the result to their existing grades. Only the
+    grades that change are updated, in bulk, and each change is recorded in a
+    ``GradeAudit``; running it again changes nothing.
+
+    Only grades given by the auto-grader are changed: a TA's grade is kept.
+    Returns the changes, as ``GradeAudit`` objects (unsaved if ``dry_run``).
+    """
+    grader = get_auto_grader()
+    quests = dict((quest.id, quest) for quest in quests.filter(
+                                            grade__graded_by=grader)\
+                                        .select_related('qtemplate', 'grade'))
+
+    changes = []
+    for qactual_id, grade_value, reason in score_quests(quests.values()):
+        grade = quests[qactual_id].grade
+        reasons = reasons_mask(reason)
+        if abs(grade.grade_value - grade_value) < 1E-9 and \
+                                                grade.reasons == reasons:
+            continue
+
+        changes.append(GradeAudit(grade=grade, qactual_id=qactual_id,
+                                  old_value=grade.grade_value,
+                                  new_value=grade_value,
+                                  old_reasons=grade.reasons,
+                                  new_reasons=reasons,
+                                  note=note))
+    if dry_run or not changes:
+        return changes
+
+    # One UPDATE per distinct result, rather than one per grade
+    grade_ids = {}
+    for change in changes:
+        grade_ids.setdefault((change.new_value, change.new_reasons),
+                             []).append(change.grade_id)
+
+    now = datetime.datetime.now()
+    with transaction.atomic():
+        for (grade_value, reasons), ids in grade_ids.iteritems():
+            for start in xrange(0, len(ids), 500):
+                Grade.objects.filter(id__in=ids[start:start+500])\
+                             .update(grade_value=grade_value,
+                                     reasons=reasons,
+                                     date_and_time=now)
+        GradeAudit.objects.bulk_create(changes, batch_size=500)
+        refresh_qset_scores((quests[change.qactual_id].user_id,
+                             quests[change.qactual_id].qset_id)
+                            for change in changes)
+
+    return changes
+
+
+def score_quest(qactual, **kwargs):
+    """
+    Grades a question (QActual) for a single student, without touching the
+    database. Keyword arguments are passed on to ``score_short``.
+
+    Returns the grade value and the list of reason codes, from
+    ``grades.models.REASON_CODES`` (``None`` if there are no reasons to
+    give). Raises ``ValueError`` for question types that are not graded
+    automatically ('numeric' and 'fib'); a TA grades those.
     """
     if qactual.given_answer == '':
-        grade = Grade.objects.create(graded_by=get_auto_grader(),
-                                     approved=True,
-                                     grade_value=0.0)
+        return 0.0, None
 
     elif qactual.qtemplate.q_type in ('tf', 'mcq', 'multi',):
-        grade = grade_MCQ(qactual)
+        return score_MCQ(qactual)
 
     elif qactual.qtemplate.q_type in ('short'):
-        grade = grade_short(qactual)
+        return score_short(qactual, **kwargs)
 
     elif qactual.qtemplate.q_type in ('long'):
-        grade = grade_long(qactual)
-
-    elif qactual.qtemplate.q_type in ('numeric'):
-        grade = grade_numeric(qactual)
-
-    elif qactual.qtemplate.q_type in ('fib'):
-        grade = grade_fib(qactual)
+        return score_long(qactual)
 
     elif qactual.qtemplate.q_type in ('peer-eval',):
-        grade = grade_peereval(qactual)
+        return score_peereval(qactual)
 
     else:
-        # TODO(KGD): else, raise an error: unspecified question type
-        assert(False)
+        raise ValueError('"%s" questions are not graded automatically' %
+                         qactual.qtemplate.q_type)
+
+
+def do_grading(qactual):
+    """
+    Performs the grading of a question (QActual) for a single student.
+    """
+    grade_value, reason = score_quest(qactual)
+    grade = Grade.objects.create(graded_by=get_auto_grader(),
+                                 approved=True,
+                                 grade_value=grade_value,
+                                 reasons=reasons_mask(reason))
 
     # Save the grade
     qactual.grade = grade
@@ -117,14 +453,14 @@ def do_grading(qactual):
     return grade  # used by outside functions that only care for the grade
 
 
-def grade_MCQ(qactual):
+def score_MCQ(qactual):
     """
     Grades multiple choice questions.
     """
     reason = []
 
     answer = json.loads(qactual.given_answer) # assume it is always a dict
-    grading = json.loads(qactual.qtemplate.t_grading)
+    grading_key = mcq_grading_key(qactual.qtemplate)
 
     grade_value = 0.0
 
@@ -132,13 +468,16 @@ def grade_MCQ(qactual):
         user_answer = answer.values()
         grade_value = 0.0
         if user_answer:
+            if user_answer[0] not in grading_key.options:
+                raise KeyError(user_answer[0])
+
             # Either the person gets the answer right, or wrong.
-            if grading[user_answer[0]][0] == 'key':
+            if user_answer[0] in grading_key.correct:
                 grade_value = qactual.qtemplate.max_grade
 
     elif qactual.qtemplate.q_type in ('multi', ):
 
-        keys = [item[0] for item in grading.items() if item[1][0]=='key']
+        keys = grading_key.correct
         grade_per_key = qactual.qtemplate.max_grade / (len(keys) + 0.0)# float
 
         for ans in answer.values()[0].strip(',').split(','): #answer.items():
@@ -148,21 +487,20 @@ def grade_MCQ(qactual):
                 grade_value -= negative_deduction_multi
 
         if grade_value != qactual.qtemplate.max_grade:
-            reason.append(reason_codes['MCQ'])
+            reason.append('MCQ')
 
     reason = list(set(reason)) # remove duplicates
-    grade = Grade.objects.create(graded_by=get_auto_grader(),
-                                 approved=True,
-                                 grade_value=grade_value,
-                                 reason_description = reason,
-                                 )
+    return grade_value, reason
 
-    return grade
 
-
-def grade_short(qactual, force_reload=False):
+def score_short(qactual, force_reload=False, rules=None,
+                numeric_results=None):
     """
     Grades short answer questions.
+
+    The ``rules`` from ``short_answer_rules`` may be given if they were
+    already parsed; ``numeric_results`` holds the results of numeric
+    comparisons already made (see ``grade_qset``), keyed by the answer field.
     """
     grade_value = 0.0
     token_dict = json.loads(qactual.given_answer)
@@ -190,76 +528,183 @@ def grade_short(qactual, force_reload=False):
 
     # Main idea: compare qactual.given_answer to qactual.grading_answer
     if qactual.grading_answer:
-        grading = json.loads(qactual.grading_answer)
-        keys = [item[0] for item in grading.items()]
-        grade_per_key = qactual.qtemplate.max_grade / (len(keys) + 0.0)
+        if rules is None:
+            rules = short_answer_rules(qactual, token_dict)
+        grade_per_key = qactual.qtemplate.max_grade / (len(rules) + 0.0)
+        numeric_results = numeric_results or {}
 
         reason = []
-
-
-        for key, value in grading.iteritems():
-            string_answer = False
-            if token_dict.has_key(key):
-
-                # TODO(KGD): remove this, after quest 8, 9 and 10 are graded
-                if isinstance(value, list) and len(value) == 1 and isinstance(value[0], basestring):
-                    try:
-                        value = eval(value[0])
-                    except NameError:
-                        if ',' in value[0]:
-                            value = value[0].split(',')
-                    except:
-                        value = deal_with_quick_eval(value[0], qactual)
-
-                if isinstance(value, list) and len(value) == 3 and not\
-                        all([isinstance(i, basestring) for i in value]):
-                    correct = value
-                elif isinstance(value, int):
-                    # TODO(KGD): Very unusual: don't allow this in the future
-                    correct = [value, 0, 'abs']
-                elif isinstance(value, list) and \
-                        all([isinstance(i, basestring) for i in value]):
-
-                    string_answer = True
-
-                elif isinstance(value[0], basestring):
-                    try:
-                        correct = json.loads(value[0].replace("'", '"'))
-                    except json.decoder.JSONDecodeError:
-                        # Happens, for example, if: u'[+1, 1E-1, "rel"]'
-                        # the "+1" does not happily get decoded.
-                        correct = eval(value[0].replace("'", '"'))
-                else:
-                    assert(False)
-
-                if string_answer:
-                    out = string_match(value, token_dict[key])
-                else:
-                    out = compare_numeric_with_precision(correct,
-                                                         token_dict[key])
-
+        for key, correct, string_answer in rules:
+            if correct is None:
+                # Not answered; or the correct answer could not be parsed
+                out = (False, 'No match' if key in token_dict else
+                              'Not answered')
+            elif string_answer:
+                out = string_match(correct, token_dict[key])
+            elif key in numeric_results:
+                out = numeric_results[key]
             else:
-                out = (False, 'Not answered')
+                out = compare_numeric_with_precision(correct, token_dict[key])
 
             if out[0]:
                 grade_value += grade_per_key
+                if out[1] == 'Spelling':
+                    reason.append('Spelling')  # accepted, but noted
             else:
-                reason.append(reason_codes[out[1]])
+                reason.append(out[1])
 
             if out[1] == 'SigFigs':
                 grade_value -= negative_sigfigs
-                reason.append(reason_codes['SigFigs'])
+                reason.append('SigFigs')
 
         reason = list(set(reason)) # remove duplicates
-        grade = Grade.objects.create(graded_by=get_auto_grader(),
-                                     approved=True,
-                                     grade_value=grade_value,
-                                     reason_description=reason)
 
-    return grade
+    return grade_value, reason
+
+
+def short_answer_rules(qactual, token_dict):
+    """
+    The rules in the ``short_grading_key`` of a short answer question, as a
+    list of (key, correct, string_answer) tuples, one per answer field.
+    ``correct`` is ``None`` for fields the user did not answer.
+    """
+    rules = []
+    for rule in short_grading_key(qactual):
+        if token_dict.has_key(rule.key):
+            rules.append(tuple(rule))
+        else:
+            rules.append((rule.key, None, False))
+
+    return rules
+
+
+def grading_key_version(*sources):
+    """
+    A hash of the ``sources`` strings that a grading key is compiled from.
+    """
+    version = hashlib.md5()
+    for source in sources:
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        version.update(source or '')
+        version.update('\x00')
+    return version.hexdigest()
+
+
+def cached_grading_key(kind, qtemplate_id, sources, compile_key):
+    """
+    Returns the grading key that ``compile_key()`` builds from the ``sources``
+    strings of template ``qtemplate_id``. The key is only compiled again if
+    the sources change, so it must not be modified by the caller.
+    """
+    cache_key = (kind, qtemplate_id, grading_key_version(*sources))
+    try:
+        return _grading_keys[cache_key]
+    except KeyError:
+        pass
+
+    grading_key = compile_key()
+    if len(_grading_keys) >= GRADING_KEY_CACHE_SIZE:
+        _grading_keys.clear()
+    _grading_keys[cache_key] = grading_key
+    return grading_key
+
+
+def mcq_grading_key(qtemplate):
+    """
+    The ``t_grading`` of a tf/mcq/multi template, compiled to an ``MCQKey``:
+    the set of all ``options``, and the set of ``correct`` ones.
+    """
+    def compile_key():
+        grading = json.loads(qtemplate.t_grading)
+        correct = [option for option, value in grading.iteritems()
+                   if value[0] == 'key']
+        return MCQKey(options=frozenset(grading), correct=frozenset(correct))
+
+    return cached_grading_key('mcq', qtemplate.id, [qtemplate.t_grading],
+                              compile_key)
+
+
+def short_grading_key(qactual):
+    """
+    The ``grading_answer`` of a short answer question, compiled to a tuple of
+    ``ShortRule``, one per answer field. ``correct`` is either a tuple of
+    acceptable strings (``string_answer`` is True) or a numeric
+    (value, precision, p_type) rule.
+
+    Questions without random variables share one compiled key.
+    """
+    return cached_grading_key('short', qactual.qtemplate_id,
+                              [qactual.grading_answer, qactual.var_dict],
+                              lambda: compile_short_rules(qactual))
+
+
+def compile_short_rules(qactual):
+    """
+    Parses the ``grading_answer`` for ``short_grading_key``, normalizing the
+    older ways the correct values were stored.
+
+    A field whose correct value cannot be parsed is logged, and gets a rule
+    with ``correct`` set to ``None``: it earns no marks, but the other fields
+    of the question are still graded.
+    """
+    grading = json.loads(qactual.grading_answer)
+    rules = []
+    for key, value in grading.iteritems():
+        try:
+            rules.append(compile_short_rule(key, value, qactual))
+        except Exception, e:
+            logger.error('Could not parse the answer to field "%s" of QActual '
+                         '%s: %s' % (key, qactual.id, str(e)))
+            rules.append(ShortRule(key, None, False))
+
+    return tuple(rules)
+
+
+def compile_short_rule(key, value, qactual):
+    """
+    The ``ShortRule`` for the correct ``value`` of answer field ``key``.
+    """
+    string_answer = False
+
+    # TODO(KGD): remove this, after quest 8, 9 and 10 are graded
+    if isinstance(value, list) and len(value) == 1 and isinstance(value[0], basestring):
+        try:
+            value = eval(value[0])
+        except NameError:
+            if ',' in value[0]:
+                value = value[0].split(',')
+        except:
+            value = deal_with_quick_eval(value[0], qactual)
+
+    if isinstance(value, list) and len(value) == 3 and not\
+            all([isinstance(i, basestring) for i in value]):
+        correct = value
+    elif isinstance(value, int):
+        # TODO(KGD): Very unusual: don't allow this in the future
+        correct = [value, 0, 'abs']
+    elif isinstance(value, list) and \
+            all([isinstance(i, basestring) for i in value]):
+
+        string_answer = True
+        correct = value
+
+    elif isinstance(value[0], basestring):
+        try:
+            correct = json.loads(value[0].replace("'", '"'))
+        except json.decoder.JSONDecodeError:
+            # Happens, for example, if: u'[+1, 1E-1, "rel"]'
+            # the "+1" does not happily get decoded.
+            correct = eval(value[0].replace("'", '"'))
+    else:
+        assert(False)
+
+    if isinstance(correct, list):
+        correct = tuple(correct)
+    return ShortRule(key, correct, string_answer)
 
 
-def grade_long(qactual):
+def score_long(qactual):
     """
     Grades long answer questions.
     """
@@ -268,65 +713,116 @@ def grade_long(qactual):
         grade_value = 0.0
     else:
         grade_value = 5.0
-    grade = Grade.objects.create(graded_by=get_auto_grader(),
-                                 approved=True,
-                                 grade_value=grade_value,
-                                 )
-    return grade
+    return grade_value, None
 
 
-def grade_peereval(qactual):
+def score_peereval(qactual):
     """
     Grades the peer evaluations.
     """
     grade_value = qactual.qtemplate.max_grade
     reason = []
-    print(len(qactual.given_answer))
     if len(qactual.given_answer) > 400 and len(qactual.given_answer) < 450:
         logger.info('Peer eval auto-grade: len=%d, ID#=%d' % (
             len(qactual.given_answer),
             qactual.id
         ))
         grade_value = 2.5
-        reason.append(reason_codes['Brief feedback'])
+        reason.append('Brief feedback')
     elif len(qactual.given_answer) < 401:
         logger.info('Peer eval auto-grade: len=%d, ID#=%d' % (
             len(qactual.given_answer),
             qactual.id
         ))
         grade_value = 0.0
-        reason.append(reason_codes['Brief feedback'])
-
-    grade = Grade.objects.create(graded_by=get_auto_grader(),
-                                approved=True,
-                                grade_value=grade_value,
-                                reason_description = reason,
-                                )
+        reason.append('Brief feedback')
 
-    return grade
+    return grade_value, reason
 
 
 def string_match(correct, given, multiple_tries=True):
     """
-    Returns whether the ``given`` string matches the ``correct`` string
+    Returns whether the ``given`` string matches one of the ``correct``
+    strings.
 
-    Ignores capitalization and hyphens
+    Ignores capitalization and hyphens. If ``QUEST['FUZZY_STRING_MATCH']``
+    is set, a ``given`` string with one typing mistake also matches, and the
+    reason is 'Spelling'.
     """
     if isinstance(correct, basestring):
         correct = [correct, ]
 
-    for item in correct:
-        item = item.strip()
-        given = given.strip()
-        given = handle_special_cases(given).replace('-', ' ')
+    min_length = settings.QUEST.get('FUZZY_MIN_LENGTH', 5)
+    index = answer_index(tuple(correct), min_length)
+    given = normalize_answer(given)
+    if given in index.exact:
+        return (True, None)
 
-
-        if item.lower() == given.lower():
-            return (True, None)
+    if settings.QUEST.get('FUZZY_STRING_MATCH', False) and \
+                                is_one_edit_away(index, given, min_length):
+        return (True, 'Spelling')
 
     return (False, 'No match')
 
 
+def normalize_answer(text):
+    """
+    The form in which string answers are compared: without surrounding
+    spaces, capitals, or hyphens (see also ``handle_special_cases``).
+    """
+    return handle_special_cases(text.strip()).replace('-', ' ').lower()
+
+
+def answer_index(correct, min_length):
+    """
+    The ``AnswerIndex`` of the ``correct`` strings (a tuple), built once for
+    each ``min_length`` and cached: the set of ``exact`` normalized answers,
+    and for the answers of at least ``min_length`` characters, the strings
+    left after deleting any one character: alone (``deletions``), and with
+    the position of the deleted character (``substitutions``).
+    """
+    try:
+        return _answer_indexes[(correct, min_length)]
+    except KeyError:
+        pass
+
+    exact = frozenset(normalize_answer(item) for item in correct)
+    deletions, substitutions = set(), set()
+    for item in exact:
+        if len(item) < min_length:
+            continue
+        for idx in xrange(len(item)):
+            deleted = item[:idx] + item[idx+1:]
+            deletions.add(deleted)
+            substitutions.add((deleted, idx))
+
+    index = AnswerIndex(exact, frozenset(deletions), frozenset(substitutions))
+    if len(_answer_indexes) >= GRADING_KEY_CACHE_SIZE:
+        _answer_indexes.clear()
+    _answer_indexes[(correct, min_length)] = index
+    return index
+
+
+def is_one_edit_away(index, given, min_length):
+    """
+    Whether the normalized ``given`` string is one deletion, insertion or
+    substitution away from an answer of at least ``min_length`` characters
+    in the ``index`` (built with the same ``min_length``). Takes one set
+    lookup per character of ``given``.
+    """
+    if given in index.deletions:
+        return True     # a character was left out
+    if not index.deletions:
+        return False
+    for idx in xrange(len(given)):
+        deleted = given[:idx] + given[idx+1:]
+        if (deleted, idx) in index.substitutions:
+            return True     # a character was mistyped
+        if deleted in index.exact and len(deleted) >= min_length:
+            return True     # an extra character was typed
+    return False
+
+
 def compare_numeric_with_precision(correct, given):
     """
     Compares precision of a ``given`` string to the ``correct`` item, to
@@ -402,6 +898,64 @@ def compare_numeric_with_precision(correct, given):
     return (True, None)
 
 
+NUMERIC_RE = re.compile(r'^\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*$')
+
+def compare_numeric_batch(corrects, givens, fallback=True):
+    """
+    Compares many ``givens`` strings at once, each to the corresponding
+    [value, precision, p_type] rule in ``corrects``. Returns a list with the
+    same (result, reason) tuples as ``compare_numeric_with_precision``.
+
+    The tolerance bounds are applied to all answers in a single NumPy
+    operation. Answers that are not plain numbers (blanks, the U+2212 minus
+    sign, text, etc), and those too close to a bound for floating point to
+    decide, are left to ``compare_numeric_with_precision`` if ``fallback``,
+    else ``None`` is returned for them.
+    """
+    n = len(givens)
+    given_v = np.zeros(n)
+    lower_b = np.zeros(n)
+    upper_b = np.zeros(n)
+    plain = np.zeros(n, dtype=bool)
+    for idx, (correct, given) in enumerate(zip(corrects, givens)):
+        if not isinstance(given, basestring) or not NUMERIC_RE.match(given):
+            continue
+        try:
+            correct_v, precision, p_type = correct
+            correct_v = float(str(correct_v))
+            precision = float(str(precision))
+        except (TypeError, ValueError):
+            continue
+
+        if p_type in ('rel', 'relative'):
+            delta = abs(correct_v * precision)
+        else:
+            delta = abs(precision)
+        given_v[idx] = float(given)
+        lower_b[idx] = correct_v - delta
+        upper_b[idx] = correct_v + delta
+        plain[idx] = True
+
+    with np.errstate(invalid='ignore', over='ignore'):
+        wrong = (given_v < lower_b) | (given_v > upper_b)
+        scale = np.maximum(np.maximum(np.abs(lower_b), np.abs(upper_b)), 1.0)
+        close = np.minimum(np.abs(given_v - lower_b),
+                           np.abs(given_v - upper_b)) <= 1E-9 * scale
+        decided = plain & ~close & np.isfinite(given_v) & \
+                  np.isfinite(lower_b) & np.isfinite(upper_b)
+
+    out = []
+    for idx in xrange(n):
+        if decided[idx]:
+            out.append((False, 'Wrong value') if wrong[idx] else (True, None))
+        elif fallback:
+            out.append(compare_numeric_with_precision(corrects[idx],
+                                                      givens[idx]))
+        else:
+            out.append(None)
+    return out
+
+
 def handle_special_cases(given):
     """
     Handles some interesting corner cases that have been observed:
@@ -435,33 +989,43 @@ def deal_with_quick_eval(eval_str, qactual):
 
 @login_required
 def grade_summary(request, course_code_slug):
+    """
+    The percentage grade of each student in each QSet of the course, latest
+    QSet first. QSets with ungraded questions show as ``nan``.
+    """
+    students = list(UserProfile.objects.filter(courses__slug=course_code_slug)\
+                                       .select_related('user'))
+    qset_ids = list(QSet.objects.filter(course__slug=course_code_slug)\
+                                .values_list('id', flat=True))
+    student_row = dict((student.id, idx) for idx, student in
+                       enumerate(students))
+    qset_col = dict((qset_id, idx) for idx, qset_id in enumerate(qset_ids))
+
+    # One row per (student, QSet)
+    totals = QSetScore.objects.filter(qset__course__slug=course_code_slug,
+                                      user__courses__slug=course_code_slug)\
+                              .values('user', 'qset', 'max_grade',
+                                      'actual_grade', 'n_quests', 'n_graded')
+
+    shape = (len(students), len(qset_ids))
+    max_grades = np.zeros(shape)
+    actual_grades = np.zeros(shape)
+    for item in totals:
+        row, col = student_row[item['user']], qset_col[item['qset']]
+        actual_grades[row, col] = item['actual_grade'] or 0.0
+        if item['n_graded'] < item['n_quests']:
+            max_grades[row, col] = np.NaN
+        else:
+            max_grades[row, col] = item['max_grade']
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentages = np.round(actual_grades / max_grades * 100, 1)[:, ::-1]
+
     results = dict()
-    students = UserProfile.objects.filter(courses__slug=course_code_slug)
-    for student in students:
-        qset_grade = []
-        qset_maxes = []
-        for qset in QSet.objects.filter(course__slug=course_code_slug):
-            max_grade = 0.0
-            actual_grade = 0.0
-            for qa in QActual.objects.filter(qset=qset).filter(user=student):
-
-                max_grade += qa.qtemplate.max_grade
-                if qa.grade:
-                    actual_grade += qa.grade.grade_value
-                else:
-                    max_grade = np.NaN
-
-            qset_grade.append(actual_grade)
-            qset_maxes.append(max_grade)
-
-
-        # All done with this student
-        qset_grade.reverse()
-        qset_maxes.reverse()
+    for student, value in zip(students, percentages):
         email = student.user.email
         prefix = email[0:email.find('@')]
-        results[prefix] = np.round(np.array(qset_grade) \
-                                              / np.array(qset_maxes) * 100, 1)
+        results[prefix] = value
 
     out = []
     for key, value in results.iteritems():
@@ -472,102 +1036,293 @@ def grade_summary(request, course_code_slug):
     return HttpResponse('\n'.join(out))
 
 
-def fix_glitch(request):
-
-    course_code_slug = 'process-control-3p4-2013-2014'
-    question_set_slug = 'quest-4-3p4-3p4-20132014'
-
-    # Iterate through all questions by all students in the QSet
-    students = UserProfile.objects.filter(courses__slug=course_code_slug)
-    qset_questions = QActual.objects.filter(qtemplate__id=961)
-
-    #for student in students:
-    for qactual in qset_questions:  #.filter(user=student).order_by('id'):
-
-        #if qactual.given_answer == '':
-        #    pass
-
-        #else:
-            #qactual.grade = 5  #
-            # grade_short(qactual, force_reload=True)
-            #if qactual.grade:
-                #if grade.grade_value != qactual.grade.grade_value:
-                    #print('Changed [%s]:(%s) -> (%s)' %
-                          #(qactual.user.slug,
-                              #qactual.grade.grade_value, grade.grade_value))
-                #qactual.grade.delete()
-        g = qactual.grade
-        g.grade_value = 5
-        g.save()
-        #qactual.save()
-            #else:
-                #assert(False)
-
-    return HttpResponse('All done')
+class Echo(object):
+    """
+    A file-like object that returns what is written to it, so ``csv.writer``
+    can produce one row at a time for a ``StreamingHttpResponse``.
+    """
+    def write(self, value):
+        return value
 
 
-def get_peer_comments(user, qactuals, username):
+@staff_member_required                        # URL: ``grading-export-grades``
+def export_grades(request, course_code_slug):
     """
-    From a QuerySet of ``qactuals`` return the comments from the ``user``'s
-    peers.
+    Streams the gradebook of the course as a CSV file (which Excel opens):
+    one row per student, with the percentage in each QSet, the average over
+    the graded QSets, and its letter grade.
     """
-    NAME = re.compile(r'strong\>(.*?)\</strong\>')
-    out = []
-    for other in user.get_peers():
-        qa = qactuals.filter(user__slug=other[1])[0]
-        if qa.grading_answer != '':
-            # Old version of peer-eval: create the grading answer
-            ans = {}
-            try:
-                ga = json.loads(qa.given_answer)
-            except json.decoder.JSONDecodeError:
-                continue
-            for item, value in ga.iteritems():
-                if item.startswith('pf__'):
-                    ans[item] = [int(value),]
-                    continue
-
-                idx = qa.as_displayed.find(item)
-                string = qa.as_displayed[idx-250:idx]
-                if 'constructive' in string:
-                    ans[item] = (NAME.search(string).group(1), 'Constructive',
-                                 ga[item])
-                elif 'appreciated' in string:
-                    ans[item] = (NAME.search(string).group(1), 'Appreciated',
-                                 ga[item])
-
-            # Store the answer
-            qa.grading_answer = json.dumps(ans)
-            qa.save()
-        else:
-            pass # already processed their QActual
-
-    # Repeat again, this time getting the actual responses
-    merged = ''
-    for other in user.get_peers():
-        qa = qactuals.filter(user__slug=other[1])[0]
+    course = Course.objects.filter(slug=course_code_slug)
+    if not course:
+        return HttpResponse('Course "%s" not found' % course_code_slug,
+                            status=404)
+    course = course[0]
+    qsets = list(QSet.objects.filter(course=course).order_by('ans_time_start')\
+                             .values_list('id', 'name'))
+
+    writer = csv.writer(Echo())
+    response = StreamingHttpResponse(gradebook_rows(writer, course, qsets),
+                                     content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="%s-grades.csv"'\
+                                      % course.slug
+    return response
+
+
+def gradebook_rows(writer, course, qsets):
+    """
+    Generates the CSV lines for ``export_grades``. The students are read a
+    page of ``IN_CLAUSE_SIZE`` at a time, by id, with their ``QSetScore``
+    totals; so memory use does not grow with the course size.
+    """
+    def encode(row):
+        return writer.writerow([unicode('' if item is None else item)\
+                                .encode('utf-8') for item in row])
+
+    # Excel only reads the file as UTF-8 if it starts with the BOM
+    yield '\xef\xbb\xbf' + encode(['Student number', 'First name',
+                                     'Last name', 'Email', 'Group'] +
+                                    [name for _, name in qsets] +
+                                    ['Average', 'Letter'])
+
+    columns = dict((qset_id, idx) for idx, (qset_id, _) in enumerate(qsets))
+    students = UserProfile.objects.filter(courses=course).order_by('id')\
+                           .values_list('id', 'student_number',
+                                        'user__first_name', 'user__last_name',
+                                        'user__email', 'group__name')
+    last_id = 0
+    while True:
+        page = list(students.filter(id__gt=last_id)[:IN_CLAUSE_SIZE])
+        if not page:
+            break
+        last_id = page[-1][0]
+
+        percentages = dict((student[0], [''] * len(qsets)) for student in page)
+        for user_id, qset_id, actual, max_grade, n_quests, n_graded in \
+                QSetScore.objects.filter(qset__course=course,
+                                         user__in=percentages.keys())\
+                                 .values_list('user', 'qset', 'actual_grade',
+                                              'max_grade', 'n_quests',
+                                              'n_graded'):
+            if n_graded == n_quests and max_grade > 0.0:
+                percentages[user_id][columns[qset_id]] = round(actual /
+                                                        max_grade * 100, 1)
+
+        for student in page:
+            graded = [item for item in percentages[student[0]] if item != '']
+            average = letter = ''
+            if graded:
+                average = round(sum(graded) / len(graded), 1)
+                letter = convert_percentage_to_letter(average)
+
+            yield encode(list(student[1:]) + percentages[student[0]] +
+                         [average, letter])
+
+
+@staff_member_required                        # URL: ``grading-item-analysis``
+def item_analysis(request, course_code_slug, question_set_slug):
+    """
+    Shows, for each question template in the QSet, how difficult it was, how
+    well it discriminated between students, and how the scores are spread.
+    The analysis is cached until a grade is added or changed.
+    """
+    qset = get_qset(course_code_slug, question_set_slug)
+    if qset is None:
+        return HttpResponse('QSet not found', status=404)
+
+    quests = QActual.objects.filter(qset=qset)
+    state = quests.aggregate(n_graded=Count('grade'),
+                             last_graded=Max('grade__date_and_time'))
+    key = ITEM_ANALYSIS_CACHE_KEY % hashlib.md5('%d-%s-%s' % (qset.id,
+                        state['n_graded'], state['last_graded'])).hexdigest()
+    items = cache.get(key)
+    if items is None:
+        items = analyze_items(quests)
+        cache.set(key, items, ITEM_ANALYSIS_TIMEOUT)
+
+    ctxdict = {'qset': qset,
+               'items': items,
+               'n_bins': ITEM_HISTOGRAM_BINS}
+    return render_to_response('grades/item-analysis.html', ctxdict,
+                              context_instance=RequestContext(request))
+
+
+def analyze_items(quests):
+    """
+    Item analysis of the graded questions in the QActual queryset ``quests``,
+    per question template, from a single query. All the statistics are
+    computed at once, with NumPy, for every template:
+
+    * ``difficulty``: the average fraction of the grade obtained
+    * ``discrimination``: the correlation between the fraction obtained and
+      the student's total score on the other questions (the point-biserial
+      correlation, for right/wrong questions)
+    * ``histogram``: the number of scores in each of ``ITEM_HISTOGRAM_BINS``
+      equal ranges of the fraction obtained
+
+    Returns a list of dictionaries, one per template, ordered by template.
+    """
+    rows = quests.filter(grade__isnull=False).order_by()\
+                 .values_list('user', 'qtemplate', 'grade__grade_value',
+                              'qtemplate__max_grade')
+    data = np.array(list(rows), dtype=float).reshape(-1, 4)
+    if not len(data):
+        return []
+
+    _, user_idx = np.unique(data[:, 0], return_inverse=True)
+    templates, item_idx = np.unique(data[:, 1], return_inverse=True)
+    n_items = len(templates)
+    grades, max_grades = data[:, 2], data[:, 3]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = np.where(max_grades > 0, grades / max_grades, 0.0)
+
+    # Each student's total on the other questions
+    rest = np.bincount(user_idx, weights=grades)[user_idx] - grades
+
+    def per_item(values):
+        return np.bincount(item_idx, weights=values, minlength=n_items)
+
+    n = np.bincount(item_idx, minlength=n_items).astype(float)
+    sum_x, sum_y = per_item(score), per_item(rest)
+    covariance = n * per_item(score * rest) - sum_x * sum_y
+    variance = (n * per_item(score ** 2) - sum_x ** 2) * \
+               (n * per_item(rest ** 2) - sum_y ** 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        difficulty = sum_x / n
+        discrimination = np.where(variance > 1E-12,
+                                  covariance / np.sqrt(variance), np.nan)
+
+    bins = np.clip((score * ITEM_HISTOGRAM_BINS).astype(int), 0,
+                   ITEM_HISTOGRAM_BINS - 1)
+    histograms = np.bincount(item_idx * ITEM_HISTOGRAM_BINS + bins,
+                             minlength=n_items * ITEM_HISTOGRAM_BINS)\
+                   .reshape(n_items, ITEM_HISTOGRAM_BINS)
+
+    names = dict(QTemplate.objects.filter(id__in=templates.astype(int)\
+                                                           .tolist())\
+                                  .values_list('id', 'name'))
+    items = []
+    for idx, qtemplate_id in enumerate(templates.astype(int)):
+        flags = []
+        if difficulty[idx] > ITEM_TOO_EASY:
+            flags.append('Too easy')
+        elif difficulty[idx] < ITEM_TOO_HARD:
+            flags.append('Too hard')
+        if np.isnan(discrimination[idx]) or \
+                         discrimination[idx] < ITEM_MIN_DISCRIMINATION:
+            flags.append('Non-discriminating')
+
+        items.append({'qtemplate_id': int(qtemplate_id),
+                      'name': names.get(int(qtemplate_id), ''),
+                      'n': int(n[idx]),
+                      'difficulty': float(difficulty[idx]),
+                      'discrimination': None if np.isnan(discrimination[idx])
+                                             else float(discrimination[idx]),
+                      'histogram': histograms[idx].tolist(),
+                      'flags': flags})
+    return items
+
+
+def peer_eval_comments(qactuals):
+    """
+    The comments and ratings that each student received from their peers,
+    from a QuerySet of peer-evaluation ``qactuals``. Returns a dictionary,
+    keyed by the UserProfile id, of lists of [peer name, comments, rating];
+    the last entry is ['Merged', all the comments, -99.9].
+
+    The questions and the members of every group are each loaded in a single
+    query. Questions stored before the ``grading_answer`` was created for
+    peer-evaluations get it derived here, and saved in one transaction.
+    """
+    quests = {}     # the (first) question of each user
+    for quest in qactuals.select_related('user__user').order_by('id'):
+        quests.setdefault(quest.user_id, quest)
+
+    members = {}    # group id: UserProfiles in the group
+    group_ids = set(quest.user.group_id for quest in quests.values()
+                    if quest.user.group_id is not None)
+    for profile in UserProfile.objects.filter(group__in=group_ids)\
+                                      .select_related('user').order_by('id'):
+        members.setdefault(profile.group_id, []).append(profile)
+
+    derived = {}
+    for quest in quests.values():
+        if quest.grading_answer in ('', '{}'):
+            grading_answer = derive_peer_grading(quest)
+            if grading_answer is not None:
+                quest.grading_answer = derived[quest.id] = grading_answer
+    with transaction.atomic():
+        for quest_id, grading_answer in derived.iteritems():
+            QActual.objects.filter(id=quest_id)\
+                           .update(grading_answer=grading_answer)
+
+    grading = {}
+    for user_id, quest in quests.iteritems():
         try:
-            gr_ans = json.loads(qa.grading_answer)
-        except json.decoder.JSONDecodeError:
-            gr_ans = {}
+            grading[user_id] = json.loads(quest.grading_answer)
+        except ValueError:
+            grading[user_id] = {}
+
+    out = {}
+    for user_id, quest in quests.iteritems():
+        user = quest.user
+        username = '%s %s' % (user.user.first_name, user.user.last_name)
+        rating_key = user.slug.replace('-', '_')
+        comments = []
+        merged = ''
+        for peer in members.get(user.group_id, []):
+            if peer.id == user_id:
+                continue
+            peer_name = '%s %s' % (peer.user.first_name, peer.user.last_name)
+            if peer.id not in quests or not quests[peer.id].given_answer:
+                comments.append([peer_name, '--No comment--', 0])
+                continue
 
-        if qa.given_answer:
-            out.append([other[0], '', None])
-            for key, val in gr_ans.iteritems():
+            comments.append([peer_name, '', None])
+            for key, val in grading[peer.id].iteritems():
                 if isinstance(val[0], basestring) and val[0] == username:
-                    out[-1][1] += "%s: %s\n" % (val[1], val[2])
+                    comments[-1][1] += "%s: %s\n" % (val[1], val[2])
                     merged += "%s: %s\n" % (val[1], val[2])
-                if isinstance(val[0], int) and user.slug.replace('-','_')\
-                                                        in key:
-                    out[-1][2] = val[0]
+                if isinstance(val[0], int) and rating_key in key:
+                    comments[-1][2] = val[0]
 
-        else:
-            out.append([other[0], '--No comment--', 0])
+        comments.append(['Merged', merged, -99.9])
+        out[user_id] = comments
 
+    return out
 
-    out.append(['Merged', merged, -99.9])
 
-    return out
+def derive_peer_grading(quest):
+    """
+    Creates the ``grading_answer`` of an older peer-evaluation question, from
+    the given answer and the question HTML: the ratings, and the comments
+    with the name of the peer they are about. Returns ``None`` if the answer
+    cannot be read.
+    """
+    NAME = re.compile(r'strong\>(.*?)\</strong\>')
+    try:
+        given = json.loads(quest.given_answer)
+    except ValueError:
+        return None
+
+    ans = {}
+    for item, value in given.iteritems():
+        if item.startswith('pf__'):
+            ans[item] = [int(value),]
+            continue
+
+        idx = quest.as_displayed.find(item)
+        if idx < 0:
+            continue
+        string = quest.as_displayed[max(idx-250, 0):idx]
+        name = NAME.search(string)
+        if name is None:
+            continue
+        if 'constructive' in string:
+            ans[item] = (name.group(1), 'Constructive', value)
+        elif 'appreciated' in string:
+            ans[item] = (name.group(1), 'Appreciated', value)
+
+    return json.dumps(ans)
 
 @login_required
 def grade_peer_eval(request):            # URL: ``admin-grade-peer-eval``
@@ -606,15 +1361,17 @@ def grade_peer_eval(request):            # URL: ``admin-grade-peer-eval``
         qtemplate_slug = request.POST.get('item_slug', '')
         qtemplate = QTemplate.objects.filter(slug=qtemplate_slug)[0]
         qactuals = QActual.objects.filter(qtemplate=qtemplate)
+        comments = peer_eval_comments(qactuals)
 
         users = []
-        for item in qactuals:
+        for item in qactuals.select_related('user__user', 'user__group',
+                                            'qset'):
             username = '%s %s' % (item.user.user.first_name,
                                   item.user.user.last_name)
 
             users.append((item.user.group.name,
                           username,
-                          get_peer_comments(item.user, qactuals, username),
+                          comments[item.user_id],
                           item.user.slug))
 
         # Sort the list in group order (the first entry in the tuple)
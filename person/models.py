@@ -1,5 +1,9 @@
+import hashlib
+import datetime
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models import signals
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 
 # Our apps:
@@ -83,7 +87,7 @@ class Token(models.Model):
     the user. They are never used to authorize access to any type of info.
     """
     user = models.ForeignKey(User)
-    token_address = models.CharField(max_length=250)
+    token_address = models.CharField(max_length=250, db_index=True)
     has_been_used = models.BooleanField(default=False)
 
     def __unicode__(self):
@@ -123,3 +127,103 @@ class Timing(models.Model):
         if self.final_time > self.qset.ans_time_final:
             raise ValidationError('Cannot end test after QSet final time.')
         super(Timing, self).save(*args, **kwargs)
+
+
+# Timing registry
+# ---------------
+# Every answer that is stored checks the user's ``Timing`` object, so the
+# deadline is kept in Django's cache once it has been looked up. With the
+# default (local memory) cache backend this is a per-process registry; set
+# ``CACHES`` to memcached, or similar, to share it between worker processes.
+TIMING_CACHE_KEY = 'quest-timing-%d-%d'
+
+def remember_timing(sender, instance, **kwargs):
+    """ Stores the deadline of a new, or changed, ``Timing`` object. """
+    # Keep it until a little after the deadline: answers arriving after that
+    # are rejected anyway, and the database can be consulted for them.
+    seconds = (instance.final_time.replace(tzinfo=None) - \
+               datetime.datetime.now()).total_seconds()
+    cache.set(TIMING_CACHE_KEY % (instance.user_id, instance.qset_id),
+              instance.final_time, max(int(seconds) + 60, 1))
+
+def forget_timing(sender, instance, **kwargs):
+    cache.delete(TIMING_CACHE_KEY % (instance.user_id, instance.qset_id))
+
+signals.post_save.connect(remember_timing, Timing)
+signals.post_delete.connect(forget_timing, Timing)
+
+def get_final_time(profile, qset):
+    """
+    Returns the ``final_time`` of the user's ``Timing`` object for the
+    ``qset``, or ``None`` if the user has not started the QSet.
+
+    Note: ``Timing.objects.filter(...).update(...)`` does not send signals;
+    rather save each ``Timing`` object, so the registry stays in sync.
+    """
+    key = TIMING_CACHE_KEY % (profile.id, qset.id)
+    final_time = cache.get(key)
+    if final_time is None:
+        timing = Timing.objects.filter(user=profile, qset=qset)[:1]
+        if not timing:
+            return None
+        remember_timing(Timing, timing[0])
+        final_time = timing[0].final_time
+
+    return final_time
+
+def timing_allows_answer(profile, qset, now_time):
+    """ Is the user still within their own time window for the ``qset``? """
+    final_time = get_final_time(profile, qset)
+    return final_time is not None and final_time > now_time
+
+
+# Token cache
+# -----------
+# Every page during a test validates the user's sign-in token. The token's
+# details are cached after the first lookup; ``prewarm_quest`` loads them
+# before a test starts. Only valid tokens are cached.
+TOKEN_CACHE_KEY = 'quest-token-%s'
+TOKEN_CACHE_TIMEOUT = 4 * 60 * 60
+
+def token_cache_key(token_address):
+    return TOKEN_CACHE_KEY % hashlib.md5(token_address.encode('utf-8'))\
+                                                                .hexdigest()
+
+def remember_token(token):
+    """
+    Caches the details of the ``Token`` object that never change, and returns
+    them with the current ``has_been_used`` value (which is not cached).
+    """
+    info = {'id': token.id,
+            'user_id': token.user_id,
+            'username': token.user.username}
+    cache.set(token_cache_key(token.token_address), info, TOKEN_CACHE_TIMEOUT)
+    info['has_been_used'] = token.has_been_used
+    return info
+
+def forget_token(sender, instance, **kwargs):
+    cache.delete(token_cache_key(instance.token_address))
+
+signals.post_save.connect(forget_token, Token)
+signals.post_delete.connect(forget_token, Token)
+
+def get_token_info(token_address):
+    """
+    Returns a dictionary with the ``id``, ``user_id``, ``username`` and
+    ``has_been_used`` details of the token, or ``None`` if it does not exist.
+
+    The token is used up when the answers are submitted, perhaps on another
+    process, so ``has_been_used`` is always read from the database.
+    """
+    info = cache.get(token_cache_key(token_address))
+    if info is None:
+        token = Token.objects.filter(token_address=token_address)\
+                             .select_related('user')[:1]
+        return remember_token(token[0]) if token else None
+
+    used = Token.objects.filter(id=info['id'])\
+                        .values_list('has_been_used', flat=True)[:1]
+    if not used:
+        return None
+    info['has_been_used'] = used[0]
+    return info
@@ -1,8 +1,9 @@
 from django.test import TestCase
 from django.test.client import Client
 from django.core.urlresolvers import reverse
-from person.models import Token, UserProfile, Timing
+from person.models import User, Token, UserProfile, Timing, get_final_time
 from django.conf import settings
+from django.core.cache import cache
 from instructor.views import (create_question_template, render)
 from course.models import Course
 from question.models import (QTemplate, QActual, QSet)
@@ -20,6 +21,10 @@ except ImportError:
     #pass
 
 class Login_TestCases(TestCase):
+    def setUp(self):
+        # Deadlines from a prior test's (rolled back) Timing objects
+        cache.clear()
+
     def test_login_before_start(self):
         c = Client(HTTP_USER_AGENT='ABC')  # enforce_csrf_checks=True,
         resp = c.get('/')#, {'username': 'john', 'password': 'smith'})
@@ -398,3 +403,40 @@ class Login_TestCases(TestCase):
     # Check that the student cannot sign in again if time has expired
     # Check that student CAN sign in again, with a new token, if time remains
 
+
+class TimingRegistry_TestCases(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_deadline_is_cached_and_invalidated(self):
+        """ Only the first deadline lookup should hit the database. """
+        now = datetime.datetime.now()
+        delta = datetime.timedelta(seconds=600)
+        course = Course.objects.create(name='Timing test course',
+                                       code='TT 1')
+        qset = QSet.objects.create(name="TIMING-TEST", course=course,
+                                   ans_time_start=now - delta,
+                                   ans_time_final=now + delta)
+        user = User.objects.create(username='timing-student',
+                                   email='timing.student@example.com')
+        student, _ = UserProfile.objects.get_or_create(user=user)
+        student.role = 'Student'
+        student.save()
+        token = Token.objects.create(user=student.user, token_address='abc')
+        self.assertEqual(get_final_time(student, qset), None)
+
+        timer = Timing.objects.create(user=student, qset=qset, token=token,
+                                      start_time=now, final_time=now + delta)
+        cache.clear()
+        self.assertEqual(get_final_time(student, qset), now + delta)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_final_time(student, qset), now + delta)
+
+        # Changes to the Timing object are picked up
+        timer.final_time = now + delta/2
+        timer.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_final_time(student, qset), now + delta/2)
+
+        timer.delete()
+        self.assertEqual(get_final_time(student, qset), None)
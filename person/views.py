@@ -12,7 +12,7 @@ from django.shortcuts import (HttpResponse, render_to_response, redirect,
                               RequestContext)
 
 # Our apps:
-from models import Token
+from models import Token, get_token_info
 from utils import generate_random_token, send_email
 from stats.models import Profile, TimerStart
 from stats.views import get_profile
@@ -192,9 +192,9 @@ class TokenSignIn(View):                    # URL: 'quest-token-sign-in'
     """ Signs the user in for a limited period.  """
     def get(self, request, token):
         logger.debug('About to process received token: ' + str(token))
-        token_item = Token.objects.filter(token_address=token)
+        token_item = get_token_info(token)
 
-        if len(token_item) == 0 or token_item[0].has_been_used:
+        if token_item is None or token_item['has_been_used']:
             logger.info('Invalid/expired token received: ' + token)
             page_content = {}
             ctxdict = {}
@@ -204,12 +204,10 @@ class TokenSignIn(View):                    # URL: 'quest-token-sign-in'
                                       context_instance=RequestContext(request))
 
         # Valid token found. Continue on.
-        user = token_item[0].user
-
         # Use Django's auth framework to mark the user as signed-in
         # authenticate() <--- use this in the future to authenticate against
         #                     other systems. We are using tokens for now.
-        user = authenticate(remote_user=user.username)
+        user = authenticate(remote_user=token_item['username'])
         login(request, user)
 
         TimerStart.objects.create(event='login',
@@ -207,6 +207,36 @@ except IOError:
 # where we will write images to and where students will upload media to
 QUEST['MEDIA_LOCATION'] = MEDIA_ROOT + '%s' + os.sep
 
+# Set to True in ``local_settings.py`` to let the browser fill in the user's
+# answers during a test. The question HTML is then sent separately, with
+# strong caching headers, and the current answers are sent as JSON.
+QUEST.setdefault('CLIENT_HYDRATION', False)
+
+# SQLite only: use write-ahead logging, so that reading does not block
+# writing (and vice versa), and wait up to this many milliseconds for a lock
+# rather than failing with "database is locked".
+QUEST.setdefault('SQLITE_WAL', True)
+QUEST.setdefault('SQLITE_BUSY_TIMEOUT', 20000)
+if DATABASES['default']['ENGINE'].endswith('sqlite3'):
+    DATABASES['default'].setdefault('OPTIONS', {}).setdefault('timeout', 20)
+
+# Set to True to store answers during a test from a single writer thread,
+# which commits many answers at a time. Off by default: with WAL on, it made
+# no measurable difference to autosave latency. Compare on your own server:
+#   python manage.py loadtest --students=200 --concurrency=50
+#   python manage.py loadtest --students=200 --concurrency=50 --write-queue
+QUEST.setdefault('ANSWER_WRITE_QUEUE', False)
+
+# Number of processes used by the ``grade_qset`` command to grade a QSet; set
+# it to the number of cores on the server that does the grading.
+QUEST.setdefault('GRADING_PROCESSES', 1)
+
+# Set to True to also accept short text answers that are one typing mistake
+# (edit distance 1) away from a correct answer; the grade notes the mistake.
+# Answers shorter than FUZZY_MIN_LENGTH must always match exactly.
+QUEST.setdefault('FUZZY_STRING_MATCH', False)
+QUEST.setdefault('FUZZY_MIN_LENGTH', 5)
+
 # A sample logging configuration. The only tangible logging
 # performed by this configuration is to send an email to
 # the site admins on every HTTP 500 error when DEBUG=False.
@@ -8,6 +8,7 @@ import stats
 from question.views import(ask_question_set, ask_show_questions,
                            ask_specific_question, store_answer,
                            submit_answers, successful_submission,
+                           quest_payload, question_fragment,
                            )
 from django.conf import settings
 
@@ -64,9 +65,15 @@ urlpatterns += patterns('',
     # The final check and the actual submission of answers go through this URL
     url(r'^submit-final-check/(?P<course_code_slug>.+)/(?P<question_set_slug>.+)/$', submit_answers, name='quest-submit-final-check'),
 
+    # ://payload/(course-code)/(question-set-slug)/
+    url(r'^payload/(?P<course_code_slug>.+)/(?P<question_set_slug>.+)/$', quest_payload, name='quest-payload'),
+
     # ://store/(course-code)/(question-set-slug)/(question-id)/
     url(r'^store/(?P<course_code_slug>.*)/(?P<question_set_slug>.*)/(?P<question_id>.*)/$', store_answer, name='quest-store-answer'),
 
+    # ://fragment/(course-code)/(question-set-slug)/(question-id)/
+    url(r'^fragment/(?P<course_code_slug>.+)/(?P<question_set_slug>.+)/(?P<question_id>.+)/$', question_fragment, name='quest-question-fragment'),
+
     # ://question/(course-code)/(question-set-slug)/(question-id)/
     url(r'^question/(?P<course_code_slug>.+)/(?P<question_set_slug>.+)/(?P<question_id>.+)/$', ask_specific_question, name='quest-ask-specific-question'),
 
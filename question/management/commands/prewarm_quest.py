@@ -0,0 +1,103 @@
+"""
+Loads everything a test needs into the cache a few minutes before it starts,
+so the rush of students signing in at the start finds a warm cache. Run it
+from cron, e.g. every 5 minutes:
+
+    python manage.py prewarm_quest --minutes=15
+
+or for a specific QSet:
+
+    python manage.py prewarm_quest <course-slug> <qset-slug>
+
+The cache must be shared by all the web server's processes (e.g. memcached);
+the default local-memory cache is private to this command's process.
+"""
+import datetime
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from utils import cache_is_shared
+from person.models import Token, remember_token
+from question.models import (QSet, QActual, PREWARM_TIMEOUT, get_qset,
+                             remember_quest_ids, get_fragment,
+                             index_answer_slots)
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class Command(BaseCommand):
+    args = '[<course-slug> <qset-slug>]'
+    help = ('Caches the QSet, sign-in tokens, question ids and question HTML '
+            'for tests that start soon.')
+    option_list = BaseCommand.option_list + (
+        make_option('--minutes', type='int', default=15,
+                    help='Pre-warm QSets starting within this many minutes'),
+    )
+
+    def handle(self, *args, **options):
+        if not cache_is_shared():
+            raise CommandError('The cache is private to each process (%s): '
+                               'configure a shared cache in CACHES, such as '
+                               'memcached, to pre-warm it' %
+                               settings.CACHES['default']['BACKEND'])
+        now = datetime.datetime.now()
+        if len(args) == 2:
+            qset = get_qset(args[0], args[1])
+            if qset is None:
+                raise CommandError('QSet "%s" not found in course "%s"' %
+                                   (args[1], args[0]))
+            qsets = [qset]
+        elif args:
+            raise CommandError('Provide both the course and the QSet slugs')
+        else:
+            soon = now + datetime.timedelta(minutes=options['minutes'])
+            qsets = QSet.objects.filter(ans_time_start__lte=soon,
+                                        ans_time_final__gt=now,
+                                        is_active=True)\
+                                .select_related('course')
+
+        for qset in qsets:
+            self.prewarm(qset, now)
+
+    def prewarm(self, qset, now):
+        # Keep everything until the test is over
+        remaining = qset.ans_time_final.replace(tzinfo=None) - now
+        timeout = max(int(remaining.total_seconds()) + 600, PREWARM_TIMEOUT)
+        get_qset(qset.course.slug, qset.slug, timeout=timeout)
+
+        # The ids of each user's questions
+        quest_ids = {}
+        for quest_id, user_id in QActual.objects.filter(qset=qset)\
+                                   .order_by('id').values_list('id', 'user'):
+            quest_ids.setdefault(user_id, []).append(quest_id)
+        for user_id, ids in quest_ids.iteritems():
+            remember_quest_ids(qset.id, user_id, ids, timeout=timeout)
+
+        # The question HTML; also index the answer fields of older questions
+        n_indexed = 0
+        quests = QActual.objects.filter(qset=qset).only('id', 'as_displayed',
+                                                        'answer_slots')
+        for quest in quests.iterator():
+            get_fragment(quest, timeout=timeout)
+            if not quest.answer_slots and quest.as_displayed:
+                QActual.objects.filter(id=quest.id).update(answer_slots=\
+                            json.dumps(index_answer_slots(quest.as_displayed)))
+                n_indexed += 1
+
+        # Tokens already sent out to the students in the test
+        n_tokens = 0
+        for token in Token.objects.filter(has_been_used=False,
+                                    user__profile__id__in=quest_ids.keys())\
+                                  .select_related('user'):
+            remember_token(token)
+            n_tokens += 1
+
+        self.stdout.write(('Pre-warmed "%s": %d users, %d questions (%d newly '
+                           'indexed), %d tokens') % (qset, len(quest_ids),
+                           sum(len(ids) for ids in quest_ids.values()),
+                           n_indexed, n_tokens))
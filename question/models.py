@@ -26,15 +26,105 @@ try:
     import simplejson as json
 except ImportError:
     import json
+import re
+import time
+import hashlib
 from collections import namedtuple
 
 from django.db import models
+from django.db.models import signals
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 #from django.template.defaultfilters import slugify
 from django.core.exceptions import ValidationError
 
 # Our imports
-from utils import unique_slugify, generate_random_token
+from utils import unique_slugify, generate_random_token, cache_is_shared
+
+# The opening tag of every answer field in the rendered question HTML, and
+# the attributes we need from it.
+ANSWER_FIELD_RE = re.compile(r'<(input|textarea)\b([^>]*)>')
+FIELD_ATTRIB_RE = re.compile(r'\b(type|name|value)="(.*?)"')
+
+# Which kinds of answer fields are filled in, for each type of question
+FILLED_FIELD_KINDS = {'tf': ('radio',),
+                      'mcq': ('radio',),
+                      'multi': ('checkbox',),
+                      'short': ('text',),
+                      'long': ('textarea',),
+                      'peer-eval': ('radio', 'textarea'),
+                      }
+
+def index_answer_slots(html):
+    """
+    Finds every answer field in the rendered question ``html`` and returns
+    a list of slots, one per field: ``[offset, kind, name, value]``.
+
+    The ``offset`` is the character position where the user's answer must be
+    spliced into the HTML; ``kind`` is one of 'radio', 'checkbox', 'text' or
+    'textarea'. For radio buttons and checkboxes the offset is just after the
+    ``value="..."`` attribute (that is where "checked" goes); for text inputs
+    it is just after ``<input``, and for an (empty) textarea it is just after
+    its opening tag.
+    """
+    slots = []
+    for field in ANSWER_FIELD_RE.finditer(html):
+        attribs = {}
+        value_end = None
+        for attrib in FIELD_ATTRIB_RE.finditer(field.group(2)):
+            attribs.setdefault(attrib.group(1), attrib.group(2))
+            if attrib.group(1) == 'value' and value_end is None:
+                value_end = field.start(2) + attrib.end()
+
+        name = attribs.get('name', None)
+        if name is None:
+            continue
+
+        if field.group(1) == 'textarea':
+            if html.startswith('</textarea>', field.end()):
+                slots.append([field.end(), 'textarea', name, ''])
+
+        elif attribs.get('type', '') in ('radio', 'checkbox'):
+            if value_end is not None:
+                slots.append([value_end, attribs['type'], name,
+                              attribs['value']])
+        else:
+            slots.append([field.start() + len('<input'), 'text', name, ''])
+
+    return slots
+
+def fill_answer_slots(html, slots, tokens, kinds):
+    """
+    Splices the user's answers, ``tokens``, into the ``html`` in a single
+    pass, using the ``slots`` found by ``index_answer_slots``. Only fields of
+    the given ``kinds`` are filled in.
+    """
+    out = []
+    start = 0
+    for offset, kind, name, value in slots:
+        if kind not in kinds:
+            continue
+
+        if kind == 'radio':
+            if tokens.get(name, '').strip() != value.strip():
+                continue
+            added = ' checked'
+        elif kind == 'checkbox':
+            if value not in tokens.get(name, '').split(','):
+                continue
+            added = ' checked'
+        elif kind == 'text':
+            added = ' value="%s"' % tokens.get(name, '')
+        elif kind == 'textarea':
+            added = tokens.get(name, '')
+
+        out.append(html[start:offset])
+        out.append(added)
+        start = offset
+
+    out.append(html[start:])
+    return ''.join(out)
+
 
 class QTemplate(models.Model):
     """
@@ -56,7 +146,7 @@ class QTemplate(models.Model):
     # e.g. "The misbehaving clock", if given explictly, else it is the first
     # few characters of the question itself.
     name = models.CharField(max_length=250)
-    slug = models.CharField(editable=False, max_length=32)
+    slug = models.CharField(editable=False, max_length=32, db_index=True)
 
     q_type = models.CharField(max_length=10, choices=question_type)
     contributor = models.ForeignKey('person.UserProfile', blank=True)
@@ -302,6 +392,11 @@ class QActual(models.Model):
     # accurate reflection of the question
     as_displayed = models.TextField(blank=True)
 
+    # Where the answer fields are located in ``as_displayed``: a JSON list
+    # created by ``index_answer_slots``. Rebuilt by ``save()`` whenever
+    # ``as_displayed`` changes.
+    answer_slots = models.TextField(blank=True)
+
     # HTML solution that's to be displayed after the question period is over
     html_solution = models.TextField(blank=True)
 
@@ -349,6 +444,10 @@ class QActual(models.Model):
     prev_q = models.ForeignKey('self', blank=True, null=True, editable=False,
                                related_name='prev_question')
 
+    class Meta:
+        # Every page during a test loads the user's questions in the QSet
+        index_together = [['qset', 'user', 'id'], ]
+
     def __unicode__(self):
         if self.qset:
             return u'%s, for user "%s", in %s of course "%s"' % (
@@ -361,15 +460,123 @@ class QActual(models.Model):
                             self.qtemplate.name,
                             self.user.user.username)
 
+    def __init__(self, *args, **kwargs):
+        super(QActual, self).__init__(*args, **kwargs)
+        # The HTML that ``answer_slots`` was built from (``None`` if deferred)
+        self._indexed_html = self.__dict__.get('as_displayed')
+
     def save(self, *args, **kwargs):
         """ Override the model's saving function to do some changes """
         if isinstance(self.var_dict, dict):
             self.var_dict = json.dumps(self.var_dict, sort_keys=True)
 
+        # Index the answer fields again if the HTML was changed; otherwise
+        # the answers would be filled in at the wrong places.
+        html_changed = 'as_displayed' in self.__dict__ and \
+                       self.as_displayed != self._indexed_html
+        if html_changed or (not self.answer_slots and self.as_displayed):
+            self.answer_slots = json.dumps(index_answer_slots(
+                               self.as_displayed)) if self.as_displayed else ''
+
         #if self.user_material:
         # TODO(KGD): validate the user's upload is OK
 
         super(QActual, self).save(*args, **kwargs)
+        if html_changed:
+            cache.delete(FRAGMENT_CACHE_KEY % self.id)
+            self._indexed_html = self.as_displayed
 
     def qtemplate_id(self, instance):
             return instance.qtemplate.id
+
+
+# Test-time caches
+# ----------------
+# Every page during a test looks up the QSet and the user's questions. These
+# are cached, and ``prewarm_quest`` fills the caches before a test starts, so
+# that the rush of students at the start of a test finds them already there.
+# These, and the question HTML, can change, so they are only cached if the
+# cache is shared by all processes.
+QSET_CACHE_KEY = 'quest-qset-%d-%s'
+QSET_GENERATION_KEY = 'quest-qset-generation'
+QUESTS_CACHE_KEY = 'quest-quests-%d-%d'
+FRAGMENT_CACHE_KEY = 'quest-fragment-%d'
+PREWARM_TIMEOUT = 4 * 60 * 60
+
+def qset_cache_generation():
+    """
+    Cached QSets are keyed by slugs, which change when the QSet is renamed.
+    Rather than tracking old slugs, every cached QSet is dropped at once, by
+    moving to a new generation, whenever any QSet changes.
+    """
+    generation = cache.get(QSET_GENERATION_KEY)
+    if generation is None:
+        cache.add(QSET_GENERATION_KEY, int(time.time()), None)
+        generation = cache.get(QSET_GENERATION_KEY, int(time.time()))
+    return generation
+
+def forget_qsets(sender, **kwargs):
+    try:
+        cache.incr(QSET_GENERATION_KEY)
+    except ValueError:
+        pass  # nothing has been cached yet
+
+signals.post_save.connect(forget_qsets, QSet)
+signals.post_delete.connect(forget_qsets, QSet)
+
+def get_qset(course_slug, qset_slug, timeout=PREWARM_TIMEOUT):
+    """
+    Returns the QSet (with its course) from the slugs, or ``None``.
+    """
+    if not cache_is_shared():
+        qset = QSet.objects.filter(slug=qset_slug, course__slug=course_slug)\
+                           .select_related('course')[:1]
+        return qset[0] if qset else None
+
+    key = QSET_CACHE_KEY % (qset_cache_generation(),
+                        hashlib.md5((u'%s/%s' % (course_slug, qset_slug))\
+                                    .encode('utf-8')).hexdigest())
+    qset = cache.get(key)
+    if qset is None:
+        qset = QSet.objects.filter(slug=qset_slug, course__slug=course_slug)\
+                           .select_related('course')[:1]
+        if not qset:
+            return None
+        qset = qset[0]
+        cache.set(key, qset, timeout)
+    return qset
+
+def remember_quest_ids(qset_id, profile_id, quest_ids, timeout=PREWARM_TIMEOUT):
+    """ Caches the ids of the user's QActual objects in the QSet. """
+    cache.set(QUESTS_CACHE_KEY % (qset_id, profile_id), quest_ids, timeout)
+
+def get_quest_ids(qset_id, profile_id):
+    """ The cached QActual ids, or ``None``; only set by ``prewarm_quest``."""
+    if not cache_is_shared():
+        return None
+    return cache.get(QUESTS_CACHE_KEY % (qset_id, profile_id))
+
+def forget_quest_ids(sender, instance, created=True, **kwargs):
+    # Only new (or deleted) questions change the list; not every answer saved
+    if created and instance.qset_id:
+        cache.delete(QUESTS_CACHE_KEY % (instance.qset_id, instance.user_id))
+
+signals.post_save.connect(forget_quest_ids, QActual)
+signals.post_delete.connect(forget_quest_ids, QActual)
+
+def get_fragment(quest, timeout=PREWARM_TIMEOUT):
+    """
+    Returns the (ETag, HTML) pair for the question, exactly as it was rendered
+    for the user. ``QActual.as_displayed`` rarely changes once created; when
+    it does, ``QActual.save()`` drops the cached pair.
+    """
+    key = FRAGMENT_CACHE_KEY % quest.id
+    fragment = cache.get(key) if cache_is_shared() else None
+    if fragment is None:
+        hashm = hashlib.md5()
+        hashm.update(quest.as_displayed.encode('utf-8'))
+        fragment = ('"%d-%s"' % (quest.id, hashm.hexdigest()),
+                    quest.as_displayed)
+        if cache_is_shared():
+            cache.set(key, fragment, timeout)
+    return fragment
@@ -0,0 +1,265 @@
+import json
+import datetime
+import tempfile
+import unittest
+from django.db import connection
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from models import (QTemplate, QSet, QActual, index_answer_slots,
+                    fill_answer_slots, FILLED_FIELD_KINDS, get_qset,
+                    get_quest_ids)
+from views import (grades_for_qsets, grades_for_quest, questions_for_listing,
+                   get_questions_for_user, ask_show_questions)
+from course.models import Course
+from grades.models import Grade
+from tagging.models import Tag
+from person.models import User, UserProfile, Token, get_token_info
+from stats.models import PageHit, Profile
+
+try:
+    import wingdbstub
+except ImportError:
+    pass
+
+
+class AnswerSlotTests(TestCase):
+    fixtures = ['initial_data',]
+    def test_mcq_radio_slots(self):
+        """ Only the selected option is checked """
+        html = ('<label><input type="radio" name="abcd" value="bX"/>Two'
+                '</label><label><input type="radio" name="abcd" value="cY"/>'
+                'Three</label>')
+        slots = index_answer_slots(html)
+        self.assertEqual([slot[1:] for slot in slots],
+                         [['radio', 'abcd', 'bX'], ['radio', 'abcd', 'cY']])
+
+        out = fill_answer_slots(html, slots, {'abcd': 'cY'},
+                                FILLED_FIELD_KINDS['mcq'])
+        self.assertEqual(out, ('<label><input type="radio" name="abcd" '
+                               'value="bX"/>Two</label><label><input '
+                               'type="radio" name="abcd" value="cY" checked/>'
+                               'Three</label>'))
+
+    def test_multi_checkbox_slots(self):
+        """ Every selected checkbox is checked """
+        html = ('<label><input type="checkbox" name="abcd" value="bX"/>Two'
+                '</label><label><input type="checkbox" name="abcd" value="cY"/>'
+                'Three</label>')
+        out = fill_answer_slots(html, index_answer_slots(html),
+                                {'abcd': 'bX,cY'},
+                                FILLED_FIELD_KINDS['multi'])
+        self.assertEqual(out.count('checked'), 2)
+
+    def test_short_and_long_answer_slots(self):
+        html = ('<p>Plots are <input type="text" name="Ab12"></input> and '
+                '<input type="text" name="Cd34"></input>.</p>')
+        out = fill_answer_slots(html, index_answer_slots(html),
+                                {'Ab12': 'bar'}, FILLED_FIELD_KINDS['short'])
+        self.assertEqual(out, ('<p>Plots are <input value="bar" type="text" '
+                               'name="Ab12"></input> and <input value="" '
+                               'type="text" name="Cd34"></input>.</p>'))
+
+        html = ('<textarea name="xyz" cols="100" rows="10" autofocus="true", '
+                'placeholder="Enter your answer here ..."></textarea>')
+        out = fill_answer_slots(html, index_answer_slots(html),
+                                {'xyz': 'My answer'},
+                                FILLED_FIELD_KINDS['long'])
+        self.assertTrue(out.endswith('>My answer</textarea>'))
+
+    def test_only_kinds_for_question_type_are_filled(self):
+        html = ('<input type="radio" name="pf__a" value="1"></input>'
+                '<textarea name="t1" cols="100" rows="3"></textarea>')
+        slots = index_answer_slots(html)
+        tokens = {'pf__a': '1', 't1': 'good work'}
+        self.assertEqual(fill_answer_slots(html, slots, tokens,
+                                           FILLED_FIELD_KINDS['long']),
+                         html.replace('></textarea>', '>good work</textarea>'))
+        out = fill_answer_slots(html, slots, tokens,
+                                FILLED_FIELD_KINDS['peer-eval'])
+        self.assertTrue('value="1" checked>' in out)
+        self.assertTrue('>good work</textarea>' in out)
+
+    def test_slots_follow_changed_html(self):
+        """ The answer fields are indexed again if the question HTML changes """
+        student, qsets = create_graded_quests(n_qsets=1, n_quests=1)
+        quest = QActual.objects.get(qset=qsets[0])
+        quest.as_displayed = '<input type="text" name="a">'
+        quest.save()
+        quest = QActual.objects.get(id=quest.id)
+        quest.as_displayed = '<p>Now: <input type="text" name="a"></p>'
+        quest.save()
+        self.assertEqual(json.loads(QActual.objects.get(id=quest.id)\
+                                                       .answer_slots),
+                         json.loads(json.dumps(index_answer_slots(
+                                                     quest.as_displayed))))
+
+
+def create_graded_quests(n_qsets=3, n_quests=4):
+    """
+    Creates a student, with ``n_qsets`` question sets of ``n_quests``
+    questions each. All questions in the first QSet are graded (1 point each,
+    out of 2); the others are not graded yet.
+    """
+    now = datetime.datetime.now()
+    user = User.objects.create(username='grade-student',
+                               email='grade.student@example.com')
+    student, _ = UserProfile.objects.get_or_create(user=user)
+    course = Course.objects.all()[0]
+    qsets = []
+    for idx in range(n_qsets):
+        qsets.append(QSet.objects.create(name='Quest %d' % idx, course=course,
+                        ans_time_start=now - datetime.timedelta(days=2),
+                        ans_time_final=now - datetime.timedelta(days=1)))
+
+    qt = QTemplate.objects.create(name='Graded question', q_type='mcq',
+                                  contributor=student, max_grade=2,
+                                  t_question='What is 1+1?', t_grading='{}')
+    for idx, qset in enumerate(qsets):
+        for _ in range(n_quests):
+            grade = None
+            if idx == 0:
+                grade = Grade.objects.create(graded_by=student,
+                                             grade_value=1.0)
+            QActual.objects.create(qtemplate=qt, qset=qset, user=student,
+                                   grade=grade)
+    return student, qsets
+
+
+class GradeQueryTests(TestCase):
+    fixtures = ['initial_data',]
+    def test_grades_for_all_qsets_in_one_query(self):
+        student, qsets = create_graded_quests()
+        with self.assertNumQueries(1):
+            grades = grades_for_qsets(qsets, student)
+
+        self.assertEqual(grades[qsets[0].id], ('4/8', 4.0, 8.0))
+        self.assertEqual(grades[qsets[1].id], (None, 0.0, 8.0))
+        self.assertEqual(grades[qsets[2].id], (None, 0.0, 8.0))
+
+    def test_question_list_query_count(self):
+        """ The question list page must not query once per question. """
+        student, qsets = create_graded_quests(n_qsets=1, n_quests=10)
+        tag, _ = Tag.objects.get_or_create(name='listing tag')
+        QTemplate.objects.all()[0].tags.add(tag)
+
+        quests = get_questions_for_user(qsets[0], student)
+        with self.assertNumQueries(2):  # questions, then their tags
+            quests = questions_for_listing(quests)
+            tags = set()
+            for item in quests:
+                for tag in item.qtemplate.tags.all():
+                    tags.add(tag)
+            grade_str = grades_for_quest(quests)[0]
+            course = quests[0].qset.course.code
+
+        self.assertEqual(len(tags), 1)
+        self.assertEqual(grade_str, '10/20')
+
+    def test_question_list_view_reads_questions_once(self):
+        """ The list page itself loads the questions once, deferred. """
+        student, qsets = create_graded_quests(n_qsets=1, n_quests=10)
+        student.courses.add(qsets[0].course)
+        Token.objects.create(user=student.user, token_address='list-token')
+        request = RequestFactory().get('/')
+        request.user = student.user
+        request.session = {'token': 'list-token'}
+
+        with CaptureQueriesContext(connection) as queries:
+            response = ask_show_questions(request, qsets[0].course.slug,
+                                          qsets[0].slug)
+        self.assertEqual(response.status_code, 200)
+        quest_queries = [query['sql'] for query in queries.captured_queries
+                         if 'FROM "question_qactual"' in query['sql']]
+        self.assertEqual(len(quest_queries), 1)
+        self.assertFalse('as_displayed' in quest_queries[0])
+
+
+SHARED_CACHE = {'default': {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': tempfile.mkdtemp(prefix='quest-cache-')}}
+
+@override_settings(CACHES=SHARED_CACHE)
+class PrewarmTests(TestCase):
+    fixtures = ['initial_data',]
+    def setUp(self):
+        cache.clear()
+
+    def test_prewarm_quest(self):
+        """ After pre-warming the QSet and question ids come from the cache """
+        student, qsets = create_graded_quests(n_qsets=1)
+        qset = qsets[0]
+        QActual.objects.filter(qset=qset).update(answer_slots='',
+                                  as_displayed='<input type="text" name="a">')
+
+        call_command('prewarm_quest', qset.course.slug, qset.slug)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_qset(qset.course.slug, qset.slug).id,
+                             qset.id)
+            quest_ids = get_quest_ids(qset.id, student.id)
+        self.assertEqual(quest_ids, list(QActual.objects.filter(qset=qset)\
+                                    .order_by('id').values_list('id', flat=True)))
+        self.assertEqual(QActual.objects.filter(qset=qset, answer_slots='')\
+                                        .count(), 0)
+
+        # Renaming the QSet drops the cached copy
+        qset.name = 'Renamed quest'
+        qset.save()
+        self.assertEqual(get_qset(qset.course.slug, qset.slug).name,
+                         'Renamed quest')
+
+    def test_prewarm_needs_shared_cache(self):
+        """ A local-memory cache cannot be pre-warmed for the web server """
+        student, qsets = create_graded_quests(n_qsets=1)
+        with override_settings(CACHES={'default': {'BACKEND':
+                            'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertRaises(CommandError, call_command, 'prewarm_quest',
+                              qsets[0].course.slug, qsets[0].slug)
+            # Nor are QSets cached across requests
+            with self.assertNumQueries(1):
+                get_qset(qsets[0].course.slug, qsets[0].slug)
+
+    def test_used_token_not_cached(self):
+        """ A token used up elsewhere is seen at once, even when cached """
+        student, qsets = create_graded_quests(n_qsets=1)
+        token = Token.objects.create(user=student.user, token_address='abc',
+                                     has_been_used=False)
+        self.assertFalse(get_token_info('abc')['has_been_used'])
+
+        # ``update()`` sends no signal, as if used on another process
+        Token.objects.filter(id=token.id).update(has_been_used=True)
+        self.assertTrue(get_token_info('abc')['has_been_used'])
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'Uses SQLite query plans')
+class QueryPlanTests(TestCase):
+    """
+    The lookups made on every page during a test must use an index, not scan
+    the whole table.
+    """
+    fixtures = ['initial_data',]
+    def assertUsesIndex(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = [row[-1] for row in cursor.fetchall()]
+        for step in plan:
+            if step.startswith('SCAN') and 'INDEX' not in step:
+                self.fail('Full table scan: %s\n%s' % (step, sql))
+
+    def test_hot_lookups_use_indexes(self):
+        self.assertUsesIndex(Token.objects.filter(token_address='abc'))
+        self.assertUsesIndex(Profile.objects.filter(hashid='abc'))
+        self.assertUsesIndex(Course.objects.filter(slug='abc'))
+        self.assertUsesIndex(QSet.objects.filter(slug='abc',
+                                                 course__slug='def'))
+        self.assertUsesIndex(QTemplate.objects.filter(slug='abc'))
+        self.assertUsesIndex(UserProfile.objects.filter(slug='abc'))
+        self.assertUsesIndex(PageHit.objects.filter(item='qactual', item_pk=1,
+                                        datetime__gte=datetime.datetime.now()))
+        self.assertUsesIndex(QActual.objects.filter(qset=1, user=2)\
+                                            .order_by('id'))
@@ -2,7 +2,9 @@
 
 # Python and Django imports
 import re
+import time
 import logging
+import hashlib
 import datetime
 try:
     import simplejson as json
@@ -10,21 +12,33 @@ except ImportError:
     import json
 
 from math import floor
+from django.conf import settings
+from django.db import transaction
 from django.db.models.query import QuerySet
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
 from django.core.context_processors import csrf
+from django.middleware.csrf import get_token
+from django.utils.http import http_date
 from django.contrib.auth.decorators import login_required
+from django.http import HttpResponseNotModified
 from django.shortcuts import (render_to_response, redirect, RequestContext,
                               HttpResponse)
 
 # 3rd party imports
 
 # Our imports
-from models import (QSet, QActual)
-from person.models import Token, Timing, UserProfile
+from models import (QSet, QActual, FILLED_FIELD_KINDS, index_answer_slots,
+                    fill_answer_slots, get_qset, get_quest_ids, get_fragment,
+                    PREWARM_TIMEOUT)
+from person.models import (Token, Timing, UserProfile, get_final_time,
+                           timing_allows_answer, get_token_info, forget_token)
 from course.models import Course
+from grades.models import Grade, QSetScore
 from stats.views import create_hit, get_profile
 from stats.models import TimerStart
-from utils import grade_display, send_email, merge_dicts
+from utils import (grade_display, send_email_later, merge_dicts,
+                   serialized_write, run_later)
 logger = logging.getLogger('quest')
 
 
@@ -62,44 +76,64 @@ def get_questions_for_user(qset, user_profile):
         # A ``UserProfile`` object must be provided.
         assert(False)
 
+    quest_ids = get_quest_ids(q.id, user_profile.id)
+    if quest_ids is not None:
+        # Pre-warmed: look the questions up by their primary keys
+        return QActual.objects.filter(id__in=quest_ids).order_by('id')
+
     return QActual.objects.filter(qset=q).filter(user=user_profile)\
                                                                 .order_by('id')
 
 
+def questions_for_listing(quests):
+    """
+    Returns the ``quests`` QuerySet with everything needed to list the
+    questions loaded up front: the templates (and their tags), grades, and
+    QSet. The large text fields are never shown in the list, so they are not
+    loaded.
+    """
+    return quests.select_related('qtemplate', 'grade', 'qset__course')\
+                 .prefetch_related('qtemplate__tags')\
+                 .defer('as_displayed', 'html_solution', 'var_dict',
+                        'given_answer', 'grading_answer', 'answer_slots',
+                        'user_comments', 'feedback',
+                        'qtemplate__t_question', 'qtemplate__t_solution',
+                        'qtemplate__t_grading', 'qtemplate__t_variables',
+                        'qtemplate__t_code')
+
+
 def validate_user(request, course_code_slug, question_set_slug,
-                  question_id=None, admin=False):
+                  question_id=None, admin=False, listing=False):
     """
     Some validation code that is common to functions below. Only validates
     authentication (not authorization).
+
+    With ``listing`` the questions are loaded as ``questions_for_listing``
+    does, so that a page which only lists them reads them just once.
     """
     user_profile = request.user.profile
     user = user_profile.user
-    courses = Course.objects.filter(slug=course_code_slug)
-    if not courses:
-        logger.info('Bad course code request: [%s]; request path="%s"' %
-                    (course_code_slug, request.path_info))
-        return redirect('quest-main-page')
-
-    qset=QSet.objects.filter(slug=question_set_slug).filter(course=courses[0])
-    if not qset:
-        logger.info('Bad question set request: [%s]; request path="%s"' %
-                    (question_set_slug, request.path_info))
+    qset = get_qset(course_code_slug, question_set_slug)
+    if qset is None:
+        logger.info('Bad course or question set request: [%s, %s]; request '
+                    'path="%s"' % (course_code_slug, question_set_slug,
+                                   request.path_info))
         return redirect('quest-main-page')
     else:
-        if not qset[0].is_active:
+        if not qset.is_active:
             logger.warn('Attempt by user "%s" to access in-active QSet [%s]' %
                         (user_profile, question_set_slug))
             return redirect('quest-main-page')
 
     if not admin:
         token = request.session.get('token', '')
-        token_obj = Token.objects.filter(token_address=token).filter(user=user)
-        if not token_obj:
+        token_obj = get_token_info(token)
+        if token_obj is None or token_obj['user_id'] != user.id:
             logger.info('Bad token used: [%s]; request path="%s"' %
                         (token, request.path_info))
             return redirect('quest-main-page')
 
-        if token_obj[0].has_been_used:
+        if token_obj['has_been_used']:
             logger.info('Token used: [%s]; session token="%s"' %
                         (request.path_info, token))
             page_content = {}
@@ -115,9 +149,11 @@ def validate_user(request, course_code_slug, question_set_slug,
     if admin:
         # Admin users only (ab)use this function to get the course and
         # question set objects, as well as to validate the admin user
-        return courses[0], qset[0]
+        return qset.course, qset
     else:
         quests = get_questions_for_user(qset, user_profile)
+        if listing:
+            quests = questions_for_listing(quests)
 
 
     if len(quests) == 0:
@@ -131,7 +167,7 @@ def validate_user(request, course_code_slug, question_set_slug,
         # mistake (i.e. no quests have been generated for the user, since they
         # were retroactively added to the course, after quest generation)
         logger.info('No quests for token [%s]; URL [%s]' %
-                    (token_obj[0], request.path_info))
+                    (token, request.path_info))
         return redirect('quest-main-page')
 
     q_id = question_id
@@ -182,12 +218,16 @@ def ask_question_set(request, course_code_slug):
         course = course[0]
 
     average = None  # in case user is not registered in any courses
-    qsets.extend(course.qset_set.order_by('-ans_time_start'))
+    qsets.extend(course.qset_set.select_related('course')\
+                                                .order_by('-ans_time_start'))
+    qset_grades = grades_for_qsets(qsets, user)
     grade = 0.0
     iterate = 0
+    now_time = datetime.datetime.now()
     for iterate, item in enumerate(qsets):
-        qsets[iterate].grade, actual, max_grade = \
-            grades_for_quest(item, user)
+        qsets[iterate].grade, actual, max_grade = qset_grades[item.id]
+        if not grades_visible(item, now_time):
+            qsets[iterate].grade, actual = None, 0.0
         if max_grade > 0.0:
             grade += actual / (max_grade + 0.0)
         else:
@@ -219,7 +259,8 @@ def ask_show_questions(request, course_code_slug, question_set_slug):
     Display questions (and perhaps answers) to questions from a question set
     for a specific user
     """
-    quests = validate_user(request, course_code_slug, question_set_slug)
+    quests = validate_user(request, course_code_slug, question_set_slug,
+                           listing=True)
     if  isinstance(quests, HttpResponse):
         return quests
     if isinstance(quests, tuple):
@@ -260,7 +301,10 @@ def ask_show_questions(request, course_code_slug, question_set_slug):
                #'seconds_left': sec_remain,
                'tag_list': list(tags),
                'grade_str': grades_for_quest(quests)[0],
+               'show_grades': grades_visible(qset, now_time),
                }
+    if not ctxdict['show_grades']:
+        ctxdict['grade_str'] = None
     ctxdict.update(csrf(request))
     return render_to_response('question/question-list.html', ctxdict,
                               context_instance=RequestContext(request))
@@ -282,141 +326,171 @@ def update_with_current_answers(quest):
     """ Takes the current question, and updates the HTML displayed to the user
     with the answers they have (partially) filled in.
     """
-    def update_radio(txt, tokens):
-        RADIO_RE = re.compile(r'<input(.*?)type="radio"(.*?)name="(.*?)"(.*?)value="(.*?)"(.*?)\<')
-        out = ''
-        start = 0
-        for item in RADIO_RE.finditer(txt):
-            val = tokens.get(item.group(3), '')
-            if val.strip() == item.group(5).strip():
-                added = ' checked '
-            else:
-                added = ''
-
-            out += '%s'*11 % \
-                (txt[start:item.start()],
-                 r'<input',
-                 item.group(1),
-                 r'type="radio"',
-                 item.group(2),
-                 'name="%s"' % item.group(3),
-                 item.group(4),
-                 'value="%s"' % item.group(5),
-                 added,
-                 item.group(6),
-                 r'<')  # leave this vague: sometimes it ends with </label>,
-                        # and other times </input>
-
-            start = item.end()
-
-        if out:
-            out += txt[start:]
+    try:
+        tokens = json.loads(quest.given_answer)
+    except json.decoder.JSONDecodeError:
+        # this is an old-style `given_answer`
+        tokens = quest.given_answer
 
+    # Start with the HTML displayed to the user
+    out = quest.as_displayed
+    if not isinstance(tokens, dict):
         return out
 
-    def update_checkbox(txt, tokens):
-        INPUT_RE = re.compile(r'\<label\>\<input(.*?)type="checkbox"(.*)name="(.*?)"(.*?)value="(.*?)"(.*?)([\n]*)\</label\>')
-        out = ''
-        start = 0
-        for item in INPUT_RE.finditer(txt):
-            extra = ''
-            if item.group(5) in tokens.get(item.group(3), '').split(','):
-                extra = 'checked'
-
-            out += '%s'*10 % \
-                (txt[start:item.start()],
-                 r'<label><input',
-                 item.group(1),
-                 r'type="checkbox"',
-                 item.group(2),
-                 'name="%s"' % item.group(3),
-                 item.group(4),
-                 r'value="%s" %s' % (item.group(5), extra),
-                 item.group(6),
-                 r'</label>')
-
-            start = item.end()
-        if out:
-            out += txt[start:]
+    if quest.answer_slots:
+        slots = json.loads(quest.answer_slots)
+    else:
+        # Questions created before the answer fields were indexed
+        slots = index_answer_slots(out)
+        quest.answer_slots = json.dumps(slots)
+        if quest.id:
+            QActual.objects.filter(id=quest.id).update(
+                                            answer_slots=quest.answer_slots)
 
-        return out
+    kinds = FILLED_FIELD_KINDS.get(quest.qtemplate.q_type, ())
+    return fill_answer_slots(out, slots, tokens, kinds)
 
-    def update_input(txt,tokens):
-        """ For short-answer questions """
-        out = ''
-        INPUT_RE = re.compile(r'\<input(.*?)name="(.*?)"(.*?)\</input\>')
-
-        if INPUT_RE.findall(txt):
-            start = 0
-            for item in INPUT_RE.finditer(txt):
-                val = tokens.get(item.group(2), '')
-                out += '%s%s%s%s%s%s' % \
-                    (txt[start:item.start()],
-                     r'<input',
-                     ' value="%s"' % val,
-                     ' name="%s"' % item.group(2),
-                     item.group(3),
-                     r'</input>')
-
-                start = item.end()
-
-            if out:
-                out += txt[start:]
-
-        if out:
-            return out
-        else:
-            return txt  # always return at least what you were given
-
-    def update_textarea(txt, tokens):
-        TEXTAREA_RE = re.compile(r'\<textarea(.*?)name="(.*?)"(.*?)\>\</textarea\>')
-        out = ''
-        start = 0
-        for item in TEXTAREA_RE.finditer(txt):
-            val = tokens.get(item.group(2), '')
-
-            out += '%s'*6 % \
-                (txt[start:item.start()],
-                 r'<textarea',
-                 item.group(1),
-                 'name="%s"%s' % (item.group(2), item.group(3)),
-                 '>%s' % val,
-                 r'</textarea>')
-
-            start = item.end()
-
-        if out:
-            out += txt[start:]
-        else:
-            out = txt   # always return at least what you were given
+# Helper function
+def disable_answer_fields(html_question, q_type):
+    """ Makes the inputs disabled when displaying solutions.
+    """
+    html_question = re.sub(r'<input', (r'<input disabled="true" '
+                                       r'style="color: #B00"'), html_question)
 
-        return out
+    if q_type in ('long', 'peer-eval'):
+        html_question = re.sub(r'<textarea', r'<textarea disabled="true"',
+                               html_question)
+    return html_question
 
-    try:
-        tokens = json.loads(quest.given_answer)
-    except json.decoder.JSONDecodeError:
-        # this is an old-style `given_answer`
-        tokens = quest.given_answer
+# Helper function
+def grades_visible(qset, now_time):
+    """
+    Grades are only shown once the QSet is finished: some questions are
+    graded as soon as they are submitted, while others may still be
+    answering.
+    """
+    return qset.ans_time_final.replace(tzinfo=None) <= now_time
 
-    # Start with the HTML displayed to the user, then progressively clean it up
-    out = quest.as_displayed
-    q_type = quest.qtemplate.q_type
+# Helper function
+def review_page_validators(request, quest, quests):
+    """
+    After the QSet is finished, the page for a question only changes when
+    the user leaves feedback (``last_edit``) or when it is (re)graded. Returns
+    the ETag and Last-Modified values for the page, so the browser can
+    revalidate its copy rather than have it rebuilt.
+    """
+    grade = quest.grade
+    changed = [quest.last_edit]
+    if grade:
+        changed.append(grade.date_and_time)
+    last_modified = max([item for item in changed if item] or [None])
+
+    hashm = hashlib.md5()
+    hashm.update('%d|%s|%s|%s|%s|%d|%s' % (quest.id, quest.last_edit,
+                                      grade and grade.id,
+                                      grade and grade.date_and_time,
+                                      quest.qtemplate.disable_solution_display,
+                                      len(quests),
+                                      get_token(request)))  # in the page
+    return '"%s"' % hashm.hexdigest(), last_modified
 
-    if q_type in ('mcq', 'tf'):
-        out = update_radio(out, tokens)
+# Helper function
+def reviewed_question_html(quest):
+    """
+    The question HTML, with the user's final answers filled in and the
+    fields disabled, as shown after the QSet is finished. It is built once
+    and cached.
+    """
+    version = '%s|%s' % (quest.last_edit, len(quest.as_displayed))
+    key = 'quest-review-%d' % quest.id
+    cached = cache.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
 
-    if q_type in ('multi',):
-        out = update_checkbox(out, tokens)
+    html_question = quest.as_displayed
+    if quest.given_answer:
+        html_question = update_with_current_answers(quest)
+    html_question = disable_answer_fields(html_question,
+                                          quest.qtemplate.q_type)
+    cache.set(key, (version, html_question), PREWARM_TIMEOUT)
+    return html_question
+
+# Helper function
+def quest_time_status(request, qset, now_time):
+    """
+    Determines where ``now_time`` lies with respect to the ``qset`` testing
+    window, and with respect to the user's own time window (their ``Timing``
+    object). The ``Timing`` object is created the first time the user views
+    the QSet during the testing window.
+
+    Returns a dictionary with these keys:
+    * ``status``: 'not-started', 'in-progress', 'expired' (the user's own time
+                  is up), or 'finished' (the QSet testing window is over)
+    * ``final_time``: when the user's time expires (``None`` if not known)
+    * ``minutes_left`` and ``seconds_left``: the time the user has left
+    * ``event_type`` and ``other_info``: used for ``TimerStart`` logging
+    """
+    out = {'status': 'in-progress',
+           'final_time': None,
+           'minutes_left': 0,
+           'seconds_left': 0,
+           'event_type': '',
+           'other_info': ''}
+
+    if qset.ans_time_start.replace(tzinfo=None) > now_time:
+        out['status'] = 'not-started'
+        return out
 
-    if q_type in ('long',):
-        out = update_textarea(out, tokens)
+    elif qset.ans_time_final.replace(tzinfo=None) <= now_time:
+        out['status'] = 'finished'
+        return out
 
-    if q_type in ('short',):
-        out = update_input(out, tokens)
+    # We are in the middle of the QSet testing period.
+    # Check for a Timing object.
+    #    If present,
+    #        Are we within the USERS time window
+    #           Y : allow question to be answered
+    #           N : throw error: time has expired.
+    #    If not present:
+    #        create one
+    final_time = get_final_time(request.user.profile, qset)
+    if final_time is not None:
+        out['event_type'] = 'attempting-quest'
+        out['final_time'] = final_time
+        if final_time <= now_time:
+            out['status'] = 'expired'
+            return out
 
-    if q_type in ('peer-eval',):
-        out = update_radio(out, tokens)
-        out = update_textarea(out, tokens)
+    else:
+        # Create the timing object, starting from right now
+        final = qset.duration()
+        intend_finish = now_time + \
+            datetime.timedelta(hours=final.hour) + \
+            datetime.timedelta(minutes=final.minute) + \
+            datetime.timedelta(seconds=final.second)
+
+        # Finish before the test if over, or earlier
+        final_time = min(intend_finish, qset.ans_time_final)
+
+        token = request.session.get('token', None)
+        if token:
+            out['event_type'] = 'start-a-quest-session'
+            out['other_info'] = 'Starting QSet; creating Timing object'
+            tobj = Timing.objects.create(user=request.user.profile,
+                                         qset=qset,
+                                         start_time=now_time,
+                                         final_time=final_time,
+                                         token_id=get_token_info(token)['id'])
+            out['final_time'] = tobj.final_time
+
+    if out['final_time'] and out['final_time'] > now_time:
+        delta = out['final_time'] - now_time
+        extra = 0
+        if delta.days:
+            extra = 60 * 24 * delta.days
+        out['minutes_left'] = int(floor(delta.seconds/60.0)) + extra
+        out['seconds_left'] = int(delta.seconds - \
+                                  int(floor(delta.seconds/60.0))*60)
 
     return out
 
@@ -440,146 +514,48 @@ def ask_specific_question(request, course_code_slug, question_set_slug,
     html_question = quest.as_displayed
     q_type = quest.qtemplate.q_type
 
-    # Has the user answered this question (even temporarily?).
-    if quest.given_answer:
-        html_question = update_with_current_answers(quest)
-
-        #if q_type in ('mcq', 'tf'):
-            #html_question = re.sub(r'"'+quest.given_answer+r'"',
-                                   #r'"'+quest.given_answer+r'" checked',
-                                   #html_question)
-
-        #if q_type in ('multi', ):
-            #for selection in quest.given_answer.split(','):
-                #html_question = re.sub(r'"'+selection+r'"',
-                                       #r'"'+selection+r'" checked',
-                                       #html_question)
-
-        #if q_type in ('long'):
-            #re_exp = TEXTAREA_RE.search(html_question)
-            #if re_exp:
-                #html_question = '%s%s%s' % (html_question[0:re_exp.start(2)],
-                                            #quest.given_answer,
-                                            #html_question[re_exp.end(2):])
-
-        #if q_type in ('short'):
-            #out = ''
-            #if INPUT_RE.findall(html_question):
-                ## INPUT_RE = (r'\<input(.*?)name="(.*?)"(.*?)\</input\>')
-                #start = 0
-                #token_dict = json.loads(quest.given_answer)
-                #for item in INPUT_RE.finditer(html_question):
-                    #val = token_dict.get(item.group(2), '')
-                    #out += '%s%s%s%s%s%s' % \
-                        #(html_question[start:item.start()],
-                         #r'<input',
-                         #' value="%s"' % val,
-                         #' name="%s"' % item.group(2),
-                         #item.group(3),
-                         #r'</input>')
-
-                    #start = item.end()
-
-                #if out:
-                    #out += html_question[start:]
-
-                #html_question = out
-
-
     # Validation types:
     show_solution = show_question = False
     fields_disabled = True
-    event_type = ''
-    other_info = ''
     item_pk = quest.id
     item_type = 'QActual'
-    min_remain = sec_remain = 0
     course = Course.objects.filter(slug=course_code_slug)[0]
     qset = quests[0].qset
     now_time = datetime.datetime.now()
 
-    if qset.ans_time_start.replace(tzinfo=None) > now_time:
+    timing = quest_time_status(request, qset, now_time)
+    event_type = timing['event_type']
+    other_info = timing['other_info']
+    min_remain = timing['minutes_left']
+    sec_remain = timing['seconds_left']
+
+    if timing['status'] == 'not-started':
         # Test has not started yet; throw "too-early"
         show_question = False
 
-    elif qset.ans_time_final.replace(tzinfo=None) <= now_time:
+    elif timing['status'] == 'finished':
         # Test is finished; show the questions, fields disabled, with solutions
         show_solution = True
         show_question = True
-        final_time = now_time + datetime.timedelta(seconds=60*60)
+
+    elif timing['status'] == 'expired':
+        # Either the user doesn't have the expiry date set in their
+        # session (i.e. they logged out and then refreshed the page)
+        # or the expiry has past the current time
+        exp = timing['final_time'].strftime('%H:%M:%S on %d %h %Y')
+        ctxdict = {'time_expired': exp,
+                   'solution_time': qset.ans_time_final}
+        ctxdict.update(csrf(request))
+        return render_to_response('question/time-expired.html',
+                                  ctxdict,
+                                  context_instance=RequestContext(request))
 
     else:
         # We are in the middle of the QSet testing period: show question but
         # no solution.
-        # Check for a Timing object.
-        #    If present,
-        #        Are we within the USERS time window
-        #           Y : allow question to be answered
-        #           N : throw error: time has expired.
-        #    If not present:
-        #        create one
-
         show_question = True
         fields_disabled = False
 
-        timing_obj = Timing.objects.filter(user=request.user.profile,
-                                           qset=qset)
-        if timing_obj:
-            tobj = timing_obj[0]
-            event_type = 'attempting-quest'
-
-            if tobj.final_time <= now_time:
-                # Either the user doesn't have the expiry date set in their
-                # session (i.e. they logged out and then refreshed the page)
-                # or the expiry has past the current time
-                exp = tobj.final_time.strftime('%H:%M:%S on %d %h %Y')
-                ctxdict = {'time_expired': exp,
-                           'solution_time': qset.ans_time_final}
-                ctxdict.update(csrf(request))
-                return render_to_response('question/time-expired.html',
-                                          ctxdict,
-                                          context_instance=RequestContext(request))
-
-        else:
-            # Create the timing object, starting from right now
-            final = qset.duration()
-            intend_finish = now_time + \
-                datetime.timedelta(hours=final.hour) + \
-                datetime.timedelta(minutes=final.minute) + \
-                datetime.timedelta(seconds=final.second)
-
-            # OLD, crufty code. We no longer use qset.max_duration
-            #if qset.max_duration == datetime.time(0, 0, 0):
-                ## Not sure why this is checked; guess it is incase the admin
-                ## user has forgot to specify the maximum time duration
-                ## Maybe it was a method to handle the case where the test was
-                ## as long in duration as the start to final time??
-                #final_time = qset.ans_time_final
-            #else:
-                ## Finish before the test if over, or earlier
-
-            final_time = min(intend_finish, qset.ans_time_final)
-
-            token = request.session.get('token', None)
-            if token:
-                event_type = 'start-a-quest-session'
-                other_info = 'Starting QSet; creating Timing object'
-                token_obj = Token.objects.filter(token_address=token)
-                tobj = Timing.objects.create(user=request.user.profile,
-                                             qset=qset,
-                                             start_time=now_time,
-                                             final_time=final_time,
-                                             token=token_obj[0])
-
-        if tobj.final_time > now_time:
-            delta = tobj.final_time - now_time
-            extra = 0
-            if delta.days:
-                extra = 60 * 24 * delta.days
-            min_remain = int(floor(delta.seconds/60.0)) + extra
-            sec_remain = int(delta.seconds - min_remain*60)
-
-
     # Now perform various actions depending on the authorizations above
     if not(show_question):
         ctxdict = {'time_to_start': qset.ans_time_start}
@@ -587,14 +563,46 @@ def ask_specific_question(request, course_code_slug, question_set_slug,
         return render_to_response('question/not-started-yet.html',
                                   ctxdict, context_instance=RequestContext(request))
 
-    if fields_disabled:
-        # Make the inputs disabled when displaying solutions:
-        html_question = re.sub(r'<input', (r'<input disabled="true" '
-                                           r'style="color: #B00"'), html_question)
+    review_etag = last_modified = None
+    if timing['status'] == 'finished':
+        review_etag, last_modified = review_page_validators(request, quest,
+                                                            quests)
+        if request.META.get('HTTP_IF_NONE_MATCH', '') == review_etag:
+            response = HttpResponseNotModified()
+            response['ETag'] = review_etag
+            return response
+
+    fragment_url = answers_json = ''
+    if review_etag:
+        html_question = reviewed_question_html(quest)
+        fields_disabled = False   # already done
+
+    elif settings.QUEST.get('CLIENT_HYDRATION', False) and \
+                                                        not fields_disabled:
+        # The browser fetches the (cacheable) question HTML and fills in the
+        # user's answers itself.
+        # The URL names the QActual and its HTML, so that it can be cached
+        fragment_url = '%s?v=%s' % (reverse('quest-question-fragment',
+                               args=(course_code_slug, question_set_slug,
+                                     q_id)), get_fragment(quest)[0].strip('"'))
+        answers = {}
+        if quest.given_answer:
+            try:
+                answers = json.loads(quest.given_answer)
+            except json.decoder.JSONDecodeError:
+                pass
+        if not isinstance(answers, dict):
+            answers = {}
+        # Escape "<" so that answers cannot close the <script> tag
+        answers_json = json.dumps(answers).replace('<', '\\u003c')
+        html_question = ''
+
+    elif quest.given_answer:
+        # Has the user answered this question (even temporarily?).
+        html_question = update_with_current_answers(quest)
 
-        if q_type in ('long', 'peer-eval'):
-            html_question = re.sub(r'<textarea', r'<textarea disabled="true"',
-                                   html_question)
+    if fields_disabled:
+        html_question = disable_answer_fields(html_question, q_type)
 
     if quest.qtemplate.disable_solution_display:
         show_solution = False
@@ -636,11 +644,161 @@ def ask_specific_question(request, course_code_slug, question_set_slug,
                'html_question': html_question,
                'html_solution': html_solution,
                'last_question': q_id==len(quests),
-               'prior_feedback': quest.feedback or ''
+               'prior_feedback': quest.feedback or '',
+               'fragment_url': fragment_url,
+               'answers_json': answers_json,
+               'show_grades': grades_visible(qset, now_time),
                }
     ctxdict.update(csrf(request))
-    return render_to_response('question/single-question.html', ctxdict,
-                              context_instance=RequestContext(request))
+    response = render_to_response('question/single-question.html', ctxdict,
+                                  context_instance=RequestContext(request))
+    if review_etag:
+        response['ETag'] = review_etag
+        if last_modified:
+            response['Last-Modified'] = http_date(time.mktime(
+                                                last_modified.timetuple()))
+        # The grade could still change: always revalidate
+        response['Cache-Control'] = 'private, no-cache'
+    return response
+
+@login_required                          # URL: ``quest-question-fragment``
+def question_fragment(request, course_code_slug, question_set_slug,
+                      question_id):
+    """
+    Returns only the question's HTML, exactly as it was rendered for the user,
+    without any answers filled in. The answers are filled in by the browser;
+    see ``ask_specific_question``.
+
+    The URL is the question's position in the QSet, plus a ``v`` version:
+    the QActual id and a hash of its HTML. The browser may only cache the
+    response indefinitely if that version is the current one.
+    """
+    quests = validate_user(request, course_code_slug, question_set_slug,
+                           question_id)
+    if isinstance(quests, HttpResponse):
+        return quests
+    if isinstance(quests, tuple):
+        quests, q_id = quests
+
+    quest = quests[q_id-1]
+    if quest.qset.ans_time_start.replace(tzinfo=None) > \
+                                                    datetime.datetime.now():
+        # Questions may not be seen before the test starts
+        return HttpResponse('', status=403)
+
+    etag, html = get_fragment(quest)
+    if request.META.get('HTTP_IF_NONE_MATCH', '') == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(html)
+    response['ETag'] = etag
+    if request.GET.get('v', '') == etag.strip('"'):
+        response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    else:
+        response['Cache-Control'] = 'private, no-cache'
+    return response
+
+@login_required                          # URL: ``quest-payload``
+def quest_payload(request, course_code_slug, question_set_slug):
+    """
+    Returns every question in the QSet for the current user as a single JSON
+    document: the rendered HTML (with the current answers filled in), the
+    current answers, and the timing and solution visibility. This lets the
+    browser page through the quest with a single request.
+
+    The response carries an ``ETag`` so the client can revalidate it cheaply.
+    The time remaining is not part of the ETag; clients should count down
+    from ``final_time`` rather than from ``seconds_left`` on a 304 response.
+    """
+    quests = validate_user(request, course_code_slug, question_set_slug)
+    if isinstance(quests, HttpResponse):
+        return quests
+    if isinstance(quests, tuple):
+        quests, _ = quests
+
+    quests = quests.select_related('qtemplate', 'qset')
+    quest_edits = list(quests.values_list('id', 'last_edit'))
+    qset = quests[0].qset
+    now_time = datetime.datetime.now()
+    timing = quest_time_status(request, qset, now_time)
+    final_time = timing['final_time']
+
+    # The ETag changes whenever any of the user's answers are stored, or the
+    # state of the QSet changes (e.g. from in-progress to finished). It only
+    # uses cheap fields, so a 304 is returned before anything is rendered.
+    hashm = hashlib.md5()
+    hashm.update('%s|%s|%s|%s|%s' % (qset.id, timing['status'], final_time,
+                                     qset.ans_time_start, qset.ans_time_final))
+    for quest_id, last_edit in quest_edits:
+        hashm.update('|%d:%s' % (quest_id, last_edit))
+    etag = '"%s"' % hashm.hexdigest()
+
+    if request.META.get('HTTP_IF_NONE_MATCH', '') == etag:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+    out = {'course': course_code_slug,
+           'qset': question_set_slug,
+           'qset_name': qset.name,
+           'status': timing['status'],
+           'final_time': final_time and final_time.isoformat() or None,
+           'minutes_left': timing['minutes_left'],
+           'seconds_left': timing['seconds_left'],
+           'quest_list': []}
+
+    if timing['status'] == 'not-started':
+        out['time_to_start'] = qset.ans_time_start.isoformat()
+    elif timing['status'] == 'expired':
+        out['solution_time'] = qset.ans_time_final.isoformat()
+    else:
+        show_solution = timing['status'] == 'finished'
+        for idx, quest in enumerate(quests):
+            q_type = quest.qtemplate.q_type
+            html_question = quest.as_displayed
+            answers = {}
+            if quest.given_answer:
+                html_question = update_with_current_answers(quest)
+                try:
+                    answers = json.loads(quest.given_answer)
+                except json.decoder.JSONDecodeError:
+                    answers = quest.given_answer
+
+            if show_solution:
+                html_question = disable_answer_fields(html_question, q_type)
+
+            if quest.qtemplate.disable_solution_display:
+                html_solution = 'The solution is disabled for this question.'
+            elif show_solution:
+                html_solution = quest.html_solution
+            else:
+                html_solution = ''
+
+            out['quest_list'].append({'id': quest.id,
+                                      'item_id': idx+1,
+                                      'q_type': q_type,
+                                      'max_grade': quest.qtemplate.max_grade,
+                                      'html_question': html_question,
+                                      'html_solution': html_solution,
+                                      'answers': answers,
+                                      'feedback': quest.feedback or ''})
+
+    if timing['event_type']:
+        TimerStart.objects.create(event=timing['event_type'],
+                                  user=request.user.profile,
+                                  profile=get_profile(request),
+                                  item_pk=qset.id,
+                                  item_type='QSet',
+                                  referrer=request.META.get('HTTP_REFERER',
+                                                            '')[0:510],
+                                  other_info=timing['other_info'])
+
+    create_hit(request, qset, extra_info='Quest payload')
+    response = HttpResponse(json.dumps(out), content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
 
 @login_required                          # URL: ``quest-submit-final-check``
 def submit_answers(request, course_code_slug, question_set_slug):
@@ -679,7 +837,7 @@ def store_answer(request, course_code_slug, question_set_slug, question_id):
     The user is submitting an answer in a real-time, during the test.
     """
 #Peer eval: merge all the textarea, input, radio and fields into 1 AJAX request
-    def clean_and_store_answer(quest):
+    def clean_and_store_answer(quest, answer_allowed=True):
         keys = request.POST.keys()
         for item in ('_', 'csrfmiddlewaretoken'):
             try:
@@ -689,8 +847,12 @@ def store_answer(request, course_code_slug, question_set_slug, question_id):
 
         logger.debug(str(request.POST))
 
-        if quest.qtemplate.q_type in ('short', 'peer-eval', 'multi', 'mcq',
-                                      'tf', 'long'):
+        old_answer = quest.given_answer
+        if not answer_allowed:
+            pass  # only feedback is accepted outside the user's time window
+
+        elif quest.qtemplate.q_type in ('short', 'peer-eval', 'multi', 'mcq',
+                                        'tf', 'long'):
             out = {}
             for key in keys:
                 newkey = key
@@ -714,14 +876,33 @@ def store_answer(request, course_code_slug, question_set_slug, question_id):
         elif request.GET.has_key('entered'):
             # The AJAX initiated GET request has this key
             quest.given_answer = request.GET['entered']
+
+        # A question graded when it was submitted must be graded again if
+        # the answer changes (only possible before the deadline). A blank
+        # answer is the same as an empty set of fields.
+        stale_grade = None
+        if (quest.given_answer or '{}') == (old_answer or '{}'):
+            quest.given_answer = old_answer
+        else:
             quest.is_submitted = False
+            if quest.grade_id:
+                stale_grade = quest.grade_id
+                quest.grade = None
 
         if request.GET.has_key('feedback'):
             # User is leaving feedback for us:
             quest.feedback = request.GET['feedback']
 
         # Save the changes made
-        quest.save()
+        if settings.QUEST.get('ANSWER_WRITE_QUEUE', False):
+            saved = serialized_write(quest.save)
+        else:
+            quest.save()
+            saved = True
+
+        if saved and stale_grade:
+            Grade.objects.filter(id=stale_grade).delete()
+        return saved
 
     if course_code_slug=='None' and question_set_slug=='None' and \
            question_id == 'Preview':
@@ -762,22 +943,17 @@ def store_answer(request, course_code_slug, question_set_slug, question_id):
         # Timing object. Are we within the USERS time window?
         #    Y : allow question to be answered
         #    N : throw error: time has expired.
-
-        timing_obj = Timing.objects.filter(user=request.user.profile, qset=qset)
-        if timing_obj:
-            tobj = timing_obj[0]
-            if tobj.final_time <= now_time:
-                invalid_response = True
-            else:
-                # The only valid condition under which we should be recording
-                # answers to questions. Any other path through this function
-                # indicates an attempt at hacking the system.
-                invalid_response = False
-        else:
-            invalid_response = True
+        # The deadline comes from the timing registry, rather than the DB.
+        #
+        # Being within the user's window is the only valid condition under
+        # which we should be recording answers to questions. Any other path
+        # through this function indicates an attempt at hacking the system.
+        invalid_response = not timing_allows_answer(request.user.profile,
+                                                    qset, now_time)
 
     # Check whether the user is leaving feedback. We only accept feedback
     # if that was the only key press
+    answer_allowed = not invalid_response
     keys = request.GET.keys()
     keys.sort()
     if keys == [u'_', u'feedback']:
@@ -788,7 +964,8 @@ def store_answer(request, course_code_slug, question_set_slug, question_id):
                     (request.user.profile, request.session.get('profile', '')))
         return HttpResponse('')
 
-    quest = clean_and_store_answer(quests[q_id-1])
+    if not clean_and_store_answer(quests[q_id-1], answer_allowed):
+        return HttpResponse('Server is busy; answer <b>NOT recorded</b>')
 
     return HttpResponse('%s: Response recorded' %
                         datetime.datetime.now().strftime('%H:%M:%S'))
@@ -802,23 +979,26 @@ def successful_submission(request, course_code_slug, question_set_slug):
     if isinstance(quests, HttpResponse):
         return quests
 
-    # Mark every question as successfully submitted
-    for quest in quests:
-        quest.is_submitted = True
-        quest.save()
-
-    if quests:
-        create_hit(request, quests[0].qset, extra_info='Submitted answers')
-
     token = request.session['token']
-
     user = request.user.profile
     final = quests[0].qset.ans_time_final.strftime('%H:%M:%S on %d %h %Y')
-    token_obj = Token.objects.filter(token_address=token).filter(user=user)
 
-    if token_obj:
-        token_obj[0].has_been_used = True
-        token_obj[0].save()
+    # Mark every question as successfully submitted, and the token as used.
+    # Use single UPDATE statements: ``update()`` does not set ``auto_now``.
+    with transaction.atomic():
+        QActual.objects.filter(id__in=[quest.id for quest in quests])\
+                       .update(is_submitted=True,
+                               last_edit=datetime.datetime.now())
+        Token.objects.filter(token_address=token, user=user.user)\
+                     .update(has_been_used=True)
+    forget_token(Token, Token(token_address=token))
+
+    # Grade the objective questions now, rather than after the deadline.
+    # (Imported here: ``grades.views`` imports from this module.)
+    from grades.views import grade_submitted_quests
+    run_later(grade_submitted_quests, [quest.id for quest in quests])
+
+    create_hit(request, quests[0].qset, extra_info='Submitted answers')
 
     TimerStart.objects.create(event='submit-qset',
                               user=user,
@@ -843,12 +1023,9 @@ def successful_submission(request, course_code_slug, question_set_slug):
     """ % quests[0].qset.ans_time_final.strftime('%H:%M on %d %h %Y')
     subject = 'Succesful Quest submission: %s' % quests[0].qset.name
 
-    out = send_email([to_address, ], subject, message)
-    if out:
-        logger.debug('Successfully sent email on QSet submission: %s' % str(to_address))
-    else:
-        logger.error('Unable to send submission confirmation email to: %s' %
-                    str(to_address))
+    # Don't hold up the response (especially close to the deadline) while
+    # the email is sent.
+    send_email_later([to_address, ], subject, message)
 
     ctxdict = {'token': token,
                'quest_cut_off': final}
@@ -862,7 +1039,7 @@ def grades_for_quest(qactuals_or_qset, user=None):
     set of quests.
     """
     if isinstance(qactuals_or_qset, QSet):
-        qactuals = QActual.objects.filter(qset=qactuals_or_qset, user=user)
+        return grades_for_qsets([qactuals_or_qset], user)[qactuals_or_qset.id]
     else:
         qactuals = qactuals_or_qset
 
@@ -880,3 +1057,28 @@ def grades_for_quest(qactuals_or_qset, user=None):
         return grade_display(actual_grade, max_grade), actual_grade, max_grade
     else:
         return None, actual_grade, max_grade
+
+
+def grades_for_qsets(qsets, user):
+    """
+    Returns the grades for the ``user`` in every QSet in ``qsets``, from
+    their ``QSetScore`` totals (a single database query).
+
+    The output is a dictionary, keyed by the QSet's id, of the same tuples
+    that ``grades_for_quest`` returns. The totals must have been built once
+    with the ``rebuild_qset_scores`` command (see ``QSetScore``).
+    """
+    out = {}
+    for score in QSetScore.objects.filter(user=user, qset__in=qsets):
+        # only show grade if all questions are graded
+        if score.is_graded():
+            grade_str = grade_display(score.actual_grade, score.max_grade)
+        else:
+            grade_str = None
+        out[score.qset_id] = (grade_str, score.actual_grade, score.max_grade)
+
+    for qset in qsets:
+        # QSets without any questions for this user
+        out.setdefault(qset.id, (grade_display(0.0, 0.0), 0.0, 0.0))
+
+    return out
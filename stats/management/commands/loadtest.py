@@ -0,0 +1,274 @@
+"""
+Simulates a class of students taking a timed QSet at the same time, and
+reports how the site copes.
+
+    python manage.py loadtest --students=400 --concurrency=50 --autosaves=10
+
+Everything happens in a throw-away SQLite database (never the real one): a
+synthetic course, QSet, questions and students are created, and each student
+is driven through the Django test client:
+
+    sign in with their token -> (view a question -> autosave) x N -> submit
+
+Latency percentiles, throughput, errors and the number of database queries
+are reported for each URL name. To compare the SQLite set-ups for autosave
+bursts, run it with ``--no-wal``, with the defaults, and with
+``--write-queue``, and compare the ``quest-store-answer`` rows.
+"""
+import os
+import math
+import time
+import Queue
+import datetime
+import tempfile
+import warnings
+import threading
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.core.urlresolvers import reverse
+from django.db import connection, connections, DEFAULT_DB_ALIAS
+from django.test.client import Client
+from django.test.utils import (CaptureQueriesContext, setup_test_environment,
+                               teardown_test_environment)
+
+QUESTION_TEXT = ('[[type]]\nMCQ\n[[question]]\nIf a=1, b=%d. What is a*b?\n'
+                 '--\n& 12\n&1\n^%d\n& 4\n')
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of the (sorted) ``values``. """
+    if not values:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class Command(BaseCommand):
+    help = ('Load tests a timed QSet, taken by many students at once, in a '
+            'temporary SQLite database.')
+    option_list = BaseCommand.option_list + (
+        make_option('--students', type='int', default=400,
+                    help='Number of students taking the QSet'),
+        make_option('--questions', type='int', default=5,
+                    help='Number of questions in the QSet'),
+        make_option('--autosaves', type='int', default=10,
+                    help='Number of answers stored by each student'),
+        make_option('--concurrency', type='int', default=50,
+                    help='Number of students active at the same time'),
+        make_option('--think-time', type='float', default=0.0,
+                    dest='think_time',
+                    help='Seconds a student waits between autosaves'),
+        make_option('--no-wal', action='store_false', default=True,
+                    dest='wal',
+                    help='Use the SQLite rollback journal instead of WAL'),
+        make_option('--write-queue', action='store_true', default=False,
+                    dest='write_queue',
+                    help='Store answers through the single writer thread'),
+        make_option('--keep-db', action='store_true', default=False,
+                    dest='keep_db',
+                    help='Do not delete the SQLite file afterwards'),
+    )
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.timings = {}           # url_name: list of (seconds, n_queries)
+        self.errors = {}            # url_name: number of failed requests
+        self.lock = threading.Lock()
+
+        db_file = os.path.join(tempfile.mkdtemp(), 'quest-loadtest.db')
+        db_settings = connection.settings_dict
+        db_settings['ENGINE'] = 'django.db.backends.sqlite3'
+        db_settings['TEST_NAME'] = db_file                   # Django 1.6
+        db_settings.setdefault('TEST', {})['NAME'] = db_file # Django 1.7+
+
+        setup_test_environment()   # in-memory email; allows 'testserver'
+        # The URLconf turns DeprecationWarnings into errors, to help find
+        # them; load it now, and undo that, so that they are not timed.
+        __import__(settings.ROOT_URLCONF)
+        warnings.simplefilter('ignore', DeprecationWarning)
+        settings.TESTING = True
+        settings.QUEST['SQLITE_WAL'] = options['wal']
+        settings.QUEST['ANSWER_WRITE_QUEUE'] = options['write_queue']
+        old_name = connection.creation.create_test_db(verbosity=0,
+                                                      autoclobber=True)
+        try:
+            self.stdout.write('Creating %d students in %s (WAL: %s; write '
+                              'queue: %s)' % (options['students'], db_file,
+                              options['wal'], options['write_queue']))
+            qset, tokens = self.create_synthetic_data()
+            connection.close()
+
+            start = time.time()
+            self.run_students(qset, tokens)
+            elapsed = time.time() - start
+            self.report(elapsed)
+        finally:
+            connection.close()
+            if options['keep_db']:
+                connection.settings_dict['NAME'] = old_name
+            else:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def create_synthetic_data(self):
+        """ Creates the course, QSet, questions and students. """
+        # Imports are here: models can only be imported once Django is set up
+        from course.models import Course
+        from instructor.views import create_question_template, render
+        from person.models import Token, UserProfile
+        from question.models import QSet, QActual
+
+        now = datetime.datetime.now()
+        course = Course.objects.create(name='Load test course', code='LT 1')
+        qset = QSet.objects.create(name='Load test', course=course,
+                              ans_time_start=now - datetime.timedelta(minutes=1),
+                              ans_time_final=now + datetime.timedelta(hours=3),
+                              max_qset_duration='02:00:00')
+
+        author = User.objects.create(username='loadtest-author')
+        author, _ = UserProfile.objects.get_or_create(user=author)
+
+        # Submitted answers are auto-graded by this user
+        grader = User.objects.create(username='quest-grader-previewer')
+        grader, _ = UserProfile.objects.get_or_create(user=grader)
+        grader.role = 'Grader'
+        grader.save()
+        qtemplates = []
+        for idx in range(self.options['questions']):
+            qtemplates.append(create_question_template(
+                                QUESTION_TEXT % (idx + 2, 2*(idx + 2)),
+                                user=author))
+
+        tokens = []
+        for idx in range(self.options['students']):
+            user = User.objects.create(username='loadtest-%05d' % idx,
+                                 email='loadtest-%05d@example.com' % idx)
+            student, _ = UserProfile.objects.get_or_create(user=user)
+            student.courses.add(course)
+            for qt in qtemplates:
+                html_q, html_a, var_dict, grading_answer = render(qt)
+                QActual.objects.create(qtemplate=qt, qset=qset, user=student,
+                                       as_displayed=html_q,
+                                       html_solution=html_a,
+                                       var_dict=var_dict,
+                                       grading_answer=grading_answer)
+
+            token = Token.objects.create(user=user,
+                                         token_address='loadtest%05d' % idx)
+            tokens.append((token.token_address, user.username))
+
+        return qset, tokens
+
+    def request(self, client, url_name, args, data=None, redirect_to=None,
+                expect_text=None):
+        """
+        Times a single GET (or POST, if there is ``data``) request. The
+        request failed unless it redirects to the ``redirect_to`` URL, if
+        given, or else returns 200 with ``expect_text`` (if given) in it: a
+        student sent back to sign in, or an answer "NOT recorded", is an
+        error.
+        """
+        url = reverse(url_name, args=args)
+        db = connections[DEFAULT_DB_ALIAS]
+        failed = False
+        start = time.time()
+        try:
+            with CaptureQueriesContext(db) as queries:
+                if data is None:
+                    resp = client.get(url)
+                else:
+                    resp = client.post(url, data)
+            if redirect_to is not None:
+                failed = resp.status_code not in (301, 302, 303) or \
+                         not resp['Location'].endswith(redirect_to)
+            else:
+                failed = resp.status_code != 200 or (expect_text is not None
+                                        and expect_text not in resp.content)
+        except Exception, e:
+            failed = True
+            self.stderr.write('%s: %s' % (url_name, str(e)))
+        duration = time.time() - start
+
+        with self.lock:
+            self.timings.setdefault(url_name, []).append((duration,
+                                                len(queries.captured_queries)))
+            if failed:
+                self.errors[url_name] = self.errors.get(url_name, 0) + 1
+
+    def one_student(self, qset, token, username):
+        """
+        Takes the QSet, the way a student would. ``RemoteUserMiddleware``
+        signs out a user that was signed in by ``RemoteUserBackend`` (as the
+        token sign-in does) on every request without a ``REMOTE_USER``, so the
+        client sends the student's username with each request.
+        """
+        client = Client(HTTP_USER_AGENT='Quest load test',
+                        REMOTE_USER=username)
+        course, slug = qset.course.slug, qset.slug
+        n_questions = self.options['questions']
+
+        self.request(client, 'quest-token-sign-in', (token, ),
+                     redirect_to=reverse('quest-course-selection'))
+        for idx in range(self.options['autosaves']):
+            q_id = str(idx % n_questions + 1)
+            self.request(client, 'quest-ask-specific-question',
+                         (course, slug, q_id))
+            self.request(client, 'quest-store-answer', (course, slug, q_id),
+                         data={'answer': str(idx)},
+                         expect_text='Response recorded')
+            if self.options['think_time']:
+                time.sleep(self.options['think_time'])
+
+        self.request(client, 'quest-submit-final-check', (course, slug),
+                     data={'honesty-statement': 'agreed'},
+                     redirect_to=reverse('quest-successful-submission',
+                                         args=(course, slug)))
+        self.request(client, 'quest-successful-submission', (course, slug))
+
+    def run_students(self, qset, tokens):
+        """ All students start together, ``concurrency`` at a time. """
+        todo = Queue.Queue()
+        for token in tokens:
+            todo.put(token)
+        go = threading.Event()
+
+        def worker():
+            go.wait()
+            try:
+                while True:
+                    try:
+                        token, username = todo.get_nowait()
+                    except Queue.Empty:
+                        return
+                    self.one_student(qset, token, username)
+            finally:
+                connections[DEFAULT_DB_ALIAS].close()
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(self.options['concurrency'])]
+        for thread in threads:
+            thread.start()
+        go.set()
+        for thread in threads:
+            thread.join()
+
+    def report(self, elapsed):
+        n_total = sum(len(item) for item in self.timings.values())
+        self.stdout.write('\n%d requests in %.1f seconds: %.1f requests/second'
+                          % (n_total, elapsed, n_total / max(elapsed, 1E-9)))
+        self.stdout.write('%-30s %7s %7s %8s %9s %9s %9s %9s' % ('URL name',
+                          'count', 'errors', 'per sec', 'p50 [ms]',
+                          'p95 [ms]', 'p99 [ms]', 'queries'))
+        for url_name, values in sorted(self.timings.items()):
+            durations = sorted(1000 * item[0] for item in values)
+            queries = [item[1] for item in values]
+            self.stdout.write('%-30s %7d %7d %8.1f %9.1f %9.1f %9.1f %9.1f' % (
+                              url_name, len(values),
+                              self.errors.get(url_name, 0),
+                              len(values) / max(elapsed, 1E-9),
+                              percentile(durations, 50),
+                              percentile(durations, 95),
+                              percentile(durations, 99),
+                              sum(queries) / float(len(queries))))
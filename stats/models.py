@@ -23,6 +23,10 @@ class PageHit(models.Model):
     user_id = models.IntegerField()
     userp = models.ForeignKey(UserProfile, null=True, blank=True, default=None)
 
+    class Meta:
+        # Hits are counted per item, over a range of dates
+        index_together = [['item', 'item_pk', 'datetime'], ]
+
     def __unicode__(self):
         if self.userp:
             return "%s [%s]" % (self.item, self.userp.slug)
@@ -46,7 +50,7 @@ class Profile(models.Model):
     display = models.CharField(max_length=255)
 
     # A hash created from the above 4 profiling objects
-    hashid = models.CharField(max_length=32)
+    hashid = models.CharField(max_length=32, db_index=True)
     datetime = models.DateTimeField(auto_now_add=True)
 
     def __unicode__(self):
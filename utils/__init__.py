@@ -3,14 +3,18 @@ from django.conf import settings
 from django.core.mail import BadHeaderError
 from django.core.mail import send_mail as _send_mail
 from django.core.mail import send_mass_mail
+from django.db import transaction, close_old_connections
+from django.db.backends.signals import connection_created
 from django.template import Context, Template
 from pygments import formatters, highlight, lexers
 
 import re
 import os
+import Queue
 import errno
 import logging
 import datetime
+import threading
 
 logger = logging.getLogger('quest')
 
@@ -220,6 +224,164 @@ def send_email(to_addresses, subject, messages):
 
     return out, to_list
 
+# Work waiting to be done by the background thread
+_background = Queue.Queue()
+_background_lock = threading.Lock()
+_background_thread = []
+
+def _background_worker():
+    while True:
+        function, args = _background.get()
+        try:
+            close_old_connections()
+            function(*args)
+        except Exception, e:
+            logger.error('Background task %s failed: %s' % (function.__name__,
+                                                            str(e)))
+        finally:
+            _background.task_done()
+
+def run_later(function, *args):
+    """
+    Calls ``function(*args)`` from a background thread, so the caller does
+    not wait for it. Queued calls are lost if the process is stopped before
+    they are made.
+
+    When testing the function is called immediately, and its result returned,
+    so tests can inspect the outcome.
+    """
+    if settings.TESTING:
+        return function(*args)
+
+    with _background_lock:
+        if not _background_thread:
+            worker = threading.Thread(target=_background_worker,
+                                      name='quest-background')
+            worker.daemon = True
+            worker.start()
+            _background_thread.append(worker)
+
+    _background.put((function, args))
+
+def _send_queued_email(to_addresses, subject, messages):
+    out, to_list = send_email(to_addresses, subject, messages)
+    if out:
+        logger.debug('Sent queued email to: %s' % str(to_list))
+    else:
+        logger.error('Unable to send queued email to: %s' % str(to_addresses))
+    return out, to_list
+
+def send_email_later(to_addresses, subject, messages):
+    """
+    Same inputs as ``send_email``, but the email is handed to the background
+    thread (see ``run_later``), so the caller does not wait for the mail
+    server.
+    """
+    return run_later(_send_queued_email, to_addresses, subject, messages)
+
+def cache_is_shared():
+    """
+    True if every process of the site sees the same cache. Django's default,
+    the local-memory cache, is private to each process: anything cached there
+    cannot be reliably forgotten when it changes on another process.
+    """
+    backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+    return backend.rsplit('.', 1)[-1] not in ('LocMemCache', 'DummyCache')
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    Tunes each new SQLite connection for many simultaneous users: see the
+    ``SQLITE_WAL`` and ``SQLITE_BUSY_TIMEOUT`` settings.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    quest_settings = getattr(settings, 'QUEST', {})
+    cursor = connection.cursor()
+    if quest_settings.get('SQLITE_WAL', True):
+        cursor.execute('PRAGMA journal_mode=WAL;')
+        # Safe in WAL mode: a power failure may only lose the last commits
+        cursor.execute('PRAGMA synchronous=NORMAL;')
+    cursor.execute('PRAGMA busy_timeout=%d;' % \
+                   quest_settings.get('SQLITE_BUSY_TIMEOUT', 20000))
+
+connection_created.connect(configure_sqlite)
+
+# Database writes waiting for the single writer thread
+_write_queue = Queue.Queue()
+_write_lock = threading.Lock()
+_write_thread = []
+WRITE_BATCH_SIZE = 200
+WRITE_TIMEOUT = 60
+
+def _write_worker():
+    while True:
+        batch = [_write_queue.get()]
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(_write_queue.get_nowait())
+            except Queue.Empty:
+                break
+
+        # Group commit: a single transaction (one disk sync) for the batch.
+        # Each write has its own savepoint, so one failure does not undo the
+        # other writes.
+        try:
+            with transaction.atomic():
+                for item in batch:
+                    with item['lock']:
+                        if item['cancelled']:
+                            continue
+                        item['started'] = True
+                    try:
+                        with transaction.atomic():
+                            item['function'](*item['args'])
+                        item['ok'] = True
+                    except Exception, e:
+                        logger.error('Queued write failed: %s' % str(e))
+        except Exception, e:
+            logger.error('Queued write batch failed: %s' % str(e))
+            for item in batch:
+                item['ok'] = False
+        finally:
+            for item in batch:
+                item['done'].set()
+
+def serialized_write(function, *args):
+    """
+    Calls ``function(*args)`` from a single writer thread, together with
+    other writes queued at about the same time, all committed in one
+    transaction. Waits for the commit, and returns True if the write
+    succeeded.
+
+    If the write has not started after ``WRITE_TIMEOUT`` seconds it is
+    cancelled, and False is returned; once started, its outcome is always
+    waited for, so that False means the write was not, and will not be, made.
+
+    With SQLite only one connection can write at a time; this avoids many
+    request threads competing for the lock.
+    """
+    with _write_lock:
+        if not _write_thread:
+            worker = threading.Thread(target=_write_worker,
+                                      name='quest-db-writer')
+            worker.daemon = True
+            worker.start()
+            _write_thread.append(worker)
+
+    item = {'function': function, 'args': args, 'ok': False,
+            'started': False, 'cancelled': False, 'lock': threading.Lock(),
+            'done': threading.Event()}
+    _write_queue.put(item)
+    if not item['done'].wait(WRITE_TIMEOUT):
+        with item['lock']:
+            if not item['started']:
+                item['cancelled'] = True
+                logger.error('Queued write cancelled after %d seconds' %
+                             WRITE_TIMEOUT)
+                return False
+        item['done'].wait()
+    return item['ok']
+
 def generate_random_token(token_length=16, base_address='', easy_use=False):
     import random
 